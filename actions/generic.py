@@ -1,19 +1,20 @@
 import abc
 import croniter
+import clients
 import common
 import config
 import datetime
 import dateutil.parser
 import json
 import logging
+import numpy as np
 import pytz
+import queries
 import random
+import recent
 import requests
 
-from google.cloud import bigquery
 from google.cloud import firestore
-from google.cloud import pubsub_v1
-from google.cloud import tasks_v2
 from google.protobuf import timestamp_pb2
 
 from sendgrid import SendGridAPIClient
@@ -70,19 +71,19 @@ class CreateAction(Action):
                 start_time = cron.get_next(datetime.datetime)
             timestamp = timestamp_pb2.Timestamp()
             timestamp.FromDatetime(start_time)
-            action['task_id'] = common.schedule_task(payload, tasks_v2.CloudTasksClient(), timestamp=timestamp)
+            action['task_id'] = common.schedule_task(payload, clients.tasks(), timestamp=timestamp)
         elif 'condition' not in action:
             logging.error('Create action is missing schedule, delay or condition')
             return
 
-        db = firestore.Client()
+        db = clients.firestore()
         db.collection(common.COLLECTIONS[parent_id['type']]).document(parent_id['value'])\
             .collection('actions').document(action['id']).set(action)
 
 
 class UpdateResource(Action):
     def process(self, identifier=None, content=None, list_name=None, delete_field=None):
-        doc_ref = firestore.Client().collection(common.COLLECTIONS[identifier['type']]).document(identifier['value'])
+        doc_ref = clients.firestore().collection(common.COLLECTIONS[identifier['type']]).document(identifier['value'])
         if delete_field:
             logging.info('Deleting field {field} {id}'.format(field=delete_field, id=doc_ref.path))
             doc_ref.update({delete_field: firestore.DELETE_FIELD})
@@ -93,6 +94,8 @@ class UpdateResource(Action):
         if not content:
             logging.warning('Empty content ' + str(content))
             return
+        if list_name == 'identifiers' and identifier['type'] in ['person', 'group']:
+            common.add_identifiers(identifier, content, clients.firestore())
         doc_ref.update({list_name: firestore.ArrayUnion(content)} if list_name else content)
 
 
@@ -107,7 +110,7 @@ class UpdateContext(Action):
 class UpdateData(Action):
     def process(self, source_id=None, params=None, content=None, tags=()):
         params = params if params else {}
-        publisher = pubsub_v1.PublisherClient()
+        publisher = clients.publisher()
         topic_path = publisher.topic_path(config.PROJECT_ID, 'data')
 
         if type(tags) == list:
@@ -137,25 +140,41 @@ class QueryData(Action):
         if not name and not source and not tag:
             return []
         start_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=common.get_duration_secs(period))
-        start_time = start_time.isoformat()
-        bq = bigquery.Client()
-        q = 'SELECT name, number, value FROM {project}.live.tsdata, UNNEST(data) ' +\
-            'WHERE time > TIMESTAMP("{start}") ' + \
-            ('AND name = "{name}" ' if name else '') +\
-            ('AND source.value = "{source}" ' if source else '') +\
-            ('AND "{tag}" IN UNNEST(tags) ' if tag else '') +\
-            'ORDER BY time'
-        q = q.format(project=config.PROJECT_ID, name=name, start=start_time, source=source, tag=tag)
-        logging.info(q)
+        rows = recent.get_data(source, [name], start_time, None, clients.firestore(), cached=False) \
+            if name and source and not tag else None
+        if rows is None:
+            rows = self.query_data(name, source, tag, start_time)
         results = {}
-        for row in bq.query(q):
+        numbers = {}
+        times = {}
+        for row in rows:
             if row['name'] not in results:
                 results[row['name']] = []
+                numbers[row['name']] = []
+                times[row['name']] = []
             if row['number']:
                 results[row['name']].append(row['number'])
             if row['value']:
                 results[row['name']].append(row['value'])
-        self.context_update = {output: {'results': results, 'names': list(results.keys())}}
+            if row['number'] is not None:
+                numbers[row['name']].append(row['number'])
+                times[row['name']].append(row['time'].timestamp())
+        # Numbers and their times (epoch seconds) as arrays for the statistics filters, e.g.
+        # {{query.arrays.glucose | time_in_range(70, 180)}} or {{query.arrays.glucose | slope(query.times.glucose)}}
+        self.context_update = {output: {'results': results, 'names': list(results.keys()),
+                                        'arrays': {name: np.array(numbers[name], dtype=np.float64) for name in numbers},
+                                        'times': {name: np.array(times[name], dtype=np.float64) for name in times}}}
+
+    @staticmethod
+    def query_data(name, source, tag, start_time):
+        query = queries.Query('tsdata', ['time', 'name', 'number', 'value'], start_time, unnest_data=True)
+        if name:
+            query.where('name = {}', name)
+        if source:
+            query.where('source.value = {}', source)
+        if tag:
+            query.where('{} IN UNNEST(tags)', tag)
+        return query.order_by('time').run()
 
 
 class Webhook(Action):
@@ -186,7 +205,7 @@ class RunAction(Action):
         timestamp.FromDatetime(now + datetime.timedelta(seconds=delay_secs))
         for action_id in [a.strip() for a in actions.split(',')]:
             payload = {'action_id': action_id, 'policy': policy, 'target_id': target_id}
-            common.schedule_task(payload, tasks_v2.CloudTasksClient(), timestamp=timestamp)
+            common.schedule_task(payload, clients.tasks(), timestamp=timestamp)
 
 
 class UpdateRelation(Action):
@@ -200,7 +219,7 @@ class UpdateRelation(Action):
             logging.warning('Invalid parameters for UpdateRelation')
             return
 
-        db = firestore.Client()
+        db = clients.firestore()
         if parent_ids and operation == 'add':
             if selection == 'random':
                 selected_parent_id = parent_ids[random.randint(0, len(parent_ids) - 1)]
@@ -214,8 +233,7 @@ class UpdateRelation(Action):
             common.add_child(child_id, add_parent_id, 'member', db)
 
         if remove_parent_id:
-            db.collection(common.COLLECTIONS[remove_parent_id['type']]).document(remove_parent_id['value']) \
-                .collection('members').document(child_id['type'] + ':' + child_id['value']).delete()
+            common.remove_child(child_id, remove_parent_id, 'member', db)
 
 
 class ListGroup(Action):
@@ -227,7 +245,7 @@ class ListGroup(Action):
         if type(parent_id) == str:
             parent_id = json.loads(parent_id)
 
-        db = firestore.Client()
+        db = clients.firestore()
         children = []
         child_ids = []
         for child_id in common.get_children_ids(parent_id, child_type, db):
@@ -0,0 +1,74 @@
+import concurrent.futures
+import datetime
+import logging
+import pytz
+
+from google.api_core import exceptions
+from google.cloud import firestore
+
+# Ledger entries backfilled from the run history are created this many at a time
+ADD_RUNS_WORKERS = 16
+
+
+def get_path(action_id, resource_id):
+    return 'runs/{type}:{value}:{action}'.format(type=resource_id['type'], value=resource_id['value'],
+                                                 action=action_id)
+
+
+def get_runs(action_ids, resource_id, db):
+    """Returns {action_id: (last run time, last content id)} for the actions that have a ledger entry."""
+    runs = {}
+    for doc in db.get_all([db.document(get_path(action_id, resource_id)) for action_id in action_ids]):
+        if doc.exists:
+            run = doc.to_dict()
+            runs[run['action']] = (run['time'] if 'time' in run else None,
+                                   run['content'] if 'content' in run else None)
+    return runs
+
+
+def add_runs(runs, resource_id, db):
+    """Creates ledger entries from the run history, including entries without time for actions that never ran.
+    Entries are created in parallel, and the ones created meanwhile by a run are kept."""
+    def add_run(action_id, run):
+        try:
+            db.document(get_path(action_id, resource_id)).create(
+                {'resource': resource_id, 'action': action_id, 'time': run[0], 'content': run[1]})
+        except exceptions.AlreadyExists:
+            logging.info('Ledger entry already exists for {} {}'.format(resource_id, action_id))
+        except Exception as ex:
+            logging.warning('Failed adding ledger entry for {} {} {}'.format(resource_id, action_id, ex))
+
+    if not runs:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(ADD_RUNS_WORKERS, len(runs))) as executor:
+        list(executor.map(add_run, runs.keys(), runs.values()))
+
+
+def claim_run(action_id, resource_id, content_id, hold_secs, db):
+    """Records the run of the action for the resource in a transaction, unless it last ran within hold_secs.
+    Returns the recorded (time, content id), or None if another run holds the action."""
+    @firestore.transactional
+    def claim(transaction, run_ref):
+        run_doc = run_ref.get(transaction=transaction)
+        run = (datetime.datetime.now(pytz.UTC), str(content_id) if content_id else None)
+        latest_run_time = run_doc.get('time') if run_doc.exists and 'time' in run_doc.to_dict() else None
+        if latest_run_time and latest_run_time > run[0] - datetime.timedelta(seconds=hold_secs):
+            return None
+        transaction.set(run_ref, {'resource': resource_id, 'action': action_id, 'time': run[0], 'content': run[1],
+                                  'count': firestore.Increment(1)}, merge=True)
+        return run
+
+    return claim(db.transaction(), db.document(get_path(action_id, resource_id)))
+
+
+def record_run(action_id, resource_id, content_id, db):
+    """Updates the ledger entry of the action for the resource and returns the recorded (time, content id)."""
+    run = (datetime.datetime.now(pytz.UTC), str(content_id) if content_id else None)
+    db.document(get_path(action_id, resource_id)).set({
+        'resource': resource_id,
+        'action': action_id,
+        'time': run[0],
+        'content': run[1],
+        'count': firestore.Increment(1)
+    }, merge=True)
+    return run
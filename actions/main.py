@@ -1,22 +1,24 @@
 import base64
 
+import clients
 import common
 import config
 import datetime
 import generic
 import json
+import ledger
 import logging
 import message as msg
 import nlp
+import policies
 import providers
 import pytz
+import queries
 import random
+import sink
 import ticket
 import traceback
 
-from google.cloud import bigquery
-from google.cloud import firestore
-
 from context import Context
 
 import google.cloud.logging as logger
@@ -40,10 +42,13 @@ ACTIONS = {
     'OpenTicket': ticket.Open,
     'CloseTicket': ticket.Close,
     'ListTickets': ticket.List,
+    'ReconcileTickets': ticket.Reconcile,
     'Webhook': generic.Webhook
 }
 
 JINJA_PARAMS = ['content', 'text']
+# Value of the resource of given type in the resources of a log row
+RESOURCE_SQL = '(SELECT value FROM UNNEST(resources) WHERE type = {})'
 
 
 def main(event, metadata):
@@ -60,7 +65,7 @@ def main(event, metadata):
         logging.info('Skipping engage schedule')
         return
 
-    db = firestore.Client()
+    db = clients.firestore()
     context = Context()
     context.set(channel_name, message)
     if channel_name == 'message':
@@ -74,13 +79,13 @@ def main(event, metadata):
         context.set('sender', common.get_resource(message['source'], db))
 
     add_shorthands(context)
-    parents = common.get_parents(context.get('sender.id'), 'member', db)
-    for coach in list(filter(lambda g: g and g.exists and g.reference.path.split('/')[0] == 'persons', parents)):
+    sender_parents = common.get_parent_paths(context.get('sender'), db)
+    receiver_parents = common.get_parent_paths(context.get('receiver'), db)
+    parents = common.get_documents(sender_parents['member'] + receiver_parents['member'] + sender_parents['admin']
+                                   + receiver_parents['admin'], db)
+    for coach in list(filter(lambda g: g and g.exists and g.reference.path.split('/')[0] == 'persons',
+                             parents[:len(sender_parents['member'])])):
         context.set('coach', coach.to_dict() | {'id': {'type': 'person', 'value': coach.id}})
-    parents.extend(common.get_parents(context.get('receiver.id'), 'member', db))
-
-    parents.extend(common.get_parents(context.get('sender.id'), 'admin', db))
-    parents.extend(common.get_parents(context.get('receiver.id'), 'admin', db))
 
     actions = []
     exclude_actions = []
@@ -95,26 +100,33 @@ def main(event, metadata):
         if resource_id and 'type' in resource_id and resource_id['type'] == 'group':
             groups.append(db.collection('groups').document(resource_id['value']).get())
     groups.append(db.collection('groups').document(config.SYSTEM_GROUP_ID).get())
-    actions.extend(get_actions(set(groups), db, exclude_actions))
+    actions.extend(policies.get_actions(set(groups), db, exclude_actions))
 
     context.set('min_action_priority', 0)
     logging.info('Context {}'.format(context.data))
-    bq = bigquery.Client()
+    bq = clients.bigquery()
+    index = policies.ConditionIndex(actions)
+    resource_id = context.get('sender.id') or context.get('receiver.id')
+    runs = get_latest_run_times([action['id'] for action in actions
+                                 if needs_latest_run(action) and index.matches(action, context)], resource_id, bq, db)
     for action in actions:
         try:
-            process_action(action, context, bq)
+            process_action(action, context, bq, index, runs, db)
         except:
             traceback.print_exc()
 
 
-def process_action(action, context, bq):
+def process_action(action, context, bq, index=None, runs=None, db=None):
+    if index and not index.matches(action, context):
+        return
+    db = db if db else clients.firestore()
     resource_id = context.get('sender.id') or context.get('receiver.id')
     context.clear('action')
     context.set('action', action)
 
     latest_run_time, latest_content_id = None, None
-    if 'hold_secs' in action or ('content_select' in action and action['content_select'] != 'random'):
-        latest_run_time, latest_content_id = get_latest_run_time(action['id'], resource_id, bq)
+    if needs_latest_run(action):
+        latest_run_time, latest_content_id = get_latest_run_time(action['id'], resource_id, bq, db, runs)
     if 'hold_secs' in action:
         threshold = datetime.datetime.utcnow() - datetime.timedelta(seconds=action['hold_secs'])
         if latest_run_time and latest_run_time > threshold.astimezone(pytz.UTC):
@@ -142,6 +154,15 @@ def process_action(action, context, bq):
         if param_name in params:
             params[param_name] = context.render(params[param_name])
 
+    has_resource = resource_id and 'type' in resource_id and 'value' in resource_id
+    run = None
+    if 'hold_secs' in action and has_resource:
+        # Claimed before processing, so concurrent invocations can't both pass the hold check
+        run = ledger.claim_run(action['id'], resource_id, content_id, action['hold_secs'], db)
+        if not run:
+            logging.info('Skipping {id} claimed by another run'.format(id=action['id']))
+            return
+
     actrun = ACTIONS[action['type']]()
     actrun.process(**params)
     logging.info(actrun.context_update)
@@ -149,16 +170,17 @@ def process_action(action, context, bq):
     if 'min_action_priority' in action:
         context.set('min_action_priority', action['min_action_priority'])
     if actrun.action_update:
-        db = firestore.Client()
         parent_id = action['parent']['id']
         db.collection(common.COLLECTIONS[parent_id['type']]).document(action['id']).update(actrun.action_update)
     log = {'time': datetime.datetime.utcnow().isoformat(), 'type': 'action.run',
            'resources': [resource_id, {'type': 'action', 'value': action['id']}]}
     if content_id:
         log['resources'].append({'type': 'content', 'value': content_id})
-    errors = bq.insert_rows_json('%s.live.log' % config.PROJECT_ID, [log])
-    if errors:
-        logging.warning(errors)
+    sink.write('log', [log])
+    if has_resource:
+        run = run if run else ledger.record_run(action['id'], resource_id, content_id, db)
+        if runs is not None:
+            runs[action['id']] = run
     return
 
 
@@ -180,49 +202,36 @@ def get_content(content, select, latest_content_id):
     return content[i]['message'], content[i]['id'] if 'id' in content[i] else None
 
 
-def get_latest_run_time(action_id, resource_id, bq):
-    if not resource_id or 'type' not in resource_id or 'value' not in resource_id:
-        return None, None
-    q = '''SELECT time, content FROM(
-        SELECT time,
-            (SELECT value FROM UNNEST(resources) 
-                WHERE type = "action") AS action,
-            (SELECT value FROM UNNEST(resources) 
-                WHERE type = "{resource_type}") AS resource,
-            (SELECT value FROM UNNEST(resources) 
-                WHERE type = "content") AS content
-        FROM `{project}.live.log`
-        WHERE type = "action.run"
-    )
-    WHERE action = "{action_id}" AND resource = "{resource_id}"
-    ORDER BY time DESC LIMIT 1'''.format(resource_type=resource_id['type'], resource_id=resource_id['value'],
-                                         action_id=action_id, project=config.PROJECT_ID)
-    latest_run_time = None
-    latest_content_id = None
-    for row in bq.query(q):
-        latest_run_time = row['time']
-        latest_content_id = row['content']
-    return latest_run_time, latest_content_id
-
-
-def get_actions(groups, db, exclude_actions):
-    actions = []
-    ids = set(exclude_actions)
-    for group_doc in groups:
-        group = group_doc.to_dict()
-        if 'policies' not in group:
-            continue
-        logging.info('Applying {} policies {}'.format(group['title'], group['policies']))
-        for policy_id in group['policies']:
-            policy = db.collection('policies').document(policy_id).get()
-            if not policy.exists:
-                continue
-            for action_id, action in policy.to_dict().items():
-                if action_id not in ids:
-                    actions.append(action | {'parent': group | {'id': common.get_id(group_doc)}})
-                    ids.add(action_id)
-    actions = sorted(actions, key=lambda action: action['priority'], reverse=True)
-    return actions
+def needs_latest_run(action):
+    return 'hold_secs' in action or ('content_select' in action and action['content_select'] != 'random')
+
+
+def get_latest_run_time(action_id, resource_id, bq, db, runs=None):
+    if runs is None or action_id not in runs:
+        runs = get_latest_run_times([action_id], resource_id, bq, db)
+    return runs.get(action_id, (None, None))
+
+
+def get_latest_run_times(action_ids, resource_id, bq, db):
+    """Returns {action_id: (latest run time, latest content id)} of given actions for the resource from the run
+    ledger, with one BigQuery query to add the actions missing in the ledger from their run history."""
+    if not action_ids or not resource_id or 'type' not in resource_id or 'value' not in resource_id:
+        return {}
+    runs = ledger.get_runs(action_ids, resource_id, db)
+    missing_ids = [action_id for action_id in action_ids if action_id not in runs]
+    if not missing_ids:
+        return runs
+    query = queries.Query('log', ['time', RESOURCE_SQL.format('"action"') + ' AS action',
+                                  RESOURCE_SQL.format('"content"') + ' AS content'], None)
+    query.where('type = {}', 'action.run')
+    query.where(RESOURCE_SQL.format('{}') + ' = {}', resource_id['type'], resource_id['value'])
+    query.where(RESOURCE_SQL.format('"action"') + ' IN UNNEST({})', missing_ids)
+    query.qualify('ROW_NUMBER() OVER (PARTITION BY action ORDER BY time DESC) = 1')
+    history = {action_id: (None, None) for action_id in missing_ids}
+    for row in query.run(bq):
+        history[row['action']] = (row['time'], row['content'])
+    ledger.add_runs(history, resource_id, db)
+    return runs | history
 
 
 def add_shorthands(context):
@@ -1,13 +1,11 @@
+import clients
 import common
 import config
 import datetime
 import json
 import logging
 import pytz
-
-from google.cloud import bigquery
-from google.cloud import firestore
-from google.cloud import pubsub_v1
+import queries
 
 from generic import Action
 
@@ -21,9 +19,9 @@ class Send(Action):
         else:
             tags = ['source:action']
 
-        publisher = pubsub_v1.PublisherClient()
+        publisher = clients.publisher()
         topic_path = publisher.topic_path(config.PROJECT_ID, 'message')
-        db = firestore.Client()
+        db = clients.firestore()
         for receiver in receiver if type(receiver) == list else [receiver]:
             if sender and type(sender) == dict and 'type' in sender and sender['type'] == 'person' and\
                     receiver and type(receiver) == dict and 'type' in receiver and receiver['type'] == 'person':
@@ -70,7 +68,7 @@ class List(Action):
     def process(self, sender_id=None, receiver_id=None, period=12*60*60, tag=None, limit=None):
         senders = []
         receivers = []
-        db = firestore.Client()
+        db = clients.firestore()
         if sender_id:
             sender = db.collection(common.COLLECTIONS[sender_id['type']]).document(sender_id['value']).get()
             senders.extend([i['value'] for i in sender.get('identifiers')])
@@ -84,19 +82,18 @@ class List(Action):
             proxy_id = common.get_proxy_id(receiver_id, sender_id, db)  # receiver is parent
             if proxy_id:
                 senders.append(proxy_id['value'])
-        q = 'SELECT time, status, sender, receiver, tags, content, content_type ' +\
-            'FROM {project}.live.messages WHERE ' +\
-            'time > TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {period} second) ' + \
-            ('AND sender.value IN ("{senders}") ' if sender_id else '') + \
-            ('AND receiver.value IN ("{receivers}") ' if receiver_id else '') +\
-            'AND "{tag}" IN UNNEST(tags) ' + \
-            'ORDER BY time' + (' DESC LIMIT {lmt}' if limit else '')
-        q = q.format(project=config.PROJECT_ID, period=period, tag=tag, lmt=limit,
-                     senders='","'.join(senders), receivers='","'.join(receivers))
-        logging.info(q)
-        bq = bigquery.Client()
+        start_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=int(period))
+        query = queries.Query('messages', ['time', 'status', 'sender', 'receiver', 'tags', 'content', 'content_type'],
+                              start_time)
+        if sender_id:
+            query.where('sender.value IN UNNEST({})', senders)
+        if receiver_id:
+            query.where('receiver.value IN UNNEST({})', receivers)
+        if tag:
+            query.where('{} IN UNNEST(tags)', tag)
+        query.order_by('time DESC' if limit else 'time').limit(limit)
         rows = []
-        for row in bq.query(q):
+        for row in query.run():
             rows.append({'time': row['time'].isoformat(),
                          'status': row['status'],
                          'sender': row['sender'],
@@ -0,0 +1,242 @@
+import common
+import functools
+import heapq
+import logging
+import time
+
+from context import ENVIRONMENT, TEMPLATES
+from jinja2 import nodes
+
+POLICY_CHECK_SECS = 60
+
+# Marks a requirement that the value at the path is truthy rather than equal to a constant
+TRUTHY = object()
+# Requirements of a condition that can never render True, like the default 'False' condition
+NEVER = None
+# Context keys that change while actions are processed, so they can't be used to pre-filter actions
+UNINDEXED_KEYS = ['action']
+# Stands for context values that can't equal condition constants, like dicts and NumPy arrays
+UNHASHABLE = object()
+
+BUNDLES = {}
+GROUP_BUNDLES = {}
+
+
+class PolicyBundle(object):
+    """Actions of one policy document sorted by priority, built once per document version."""
+    def __init__(self, policy_id, update_time=None, actions=()):
+        self.id = policy_id
+        self.update_time = update_time
+        self.checked = time.time()
+        self.actions = tuple(sorted(actions, key=lambda action: action['priority'], reverse=True))
+        for action in self.actions:
+            if 'condition' not in action:
+                continue
+            try:
+                TEMPLATES.get(action['condition'])
+            except:
+                logging.warning('Invalid condition for {} {}'.format(action['id'], action['condition']))
+
+    @staticmethod
+    def from_document(policy_doc):
+        if not policy_doc.exists:
+            return PolicyBundle(policy_doc.id)
+        actions = [action | {'id': action['id'] if 'id' in action else action_id}
+                   for action_id, action in policy_doc.to_dict().items()]
+        return PolicyBundle(policy_doc.id, policy_doc.update_time, actions)
+
+
+class GroupBundle(object):
+    """Priority sorted actions of all the policies of a group with the group set as their parent."""
+    def __init__(self, group_doc, bundles):
+        self.update_time = group_doc.update_time
+        self.bundles = bundles
+        group = group_doc.to_dict()
+        parent = group | {'id': common.get_id(group_doc)}
+        ids = set()
+        actions = []
+        for bundle in bundles:
+            for action in bundle.actions:
+                if action['id'] not in ids:
+                    actions.append(action | {'parent': parent})
+                    ids.add(action['id'])
+        self.actions = tuple(sorted(actions, key=lambda action: action['priority'], reverse=True))
+
+    def is_valid(self, group_doc, bundles):
+        return self.update_time == group_doc.update_time and len(bundles) == len(self.bundles) \
+            and all(bundle is cached for bundle, cached in zip(bundles, self.bundles))
+
+
+def get_bundles(policy_ids, db):
+    """Returns the policy bundles for given ids, re-reading (in one batch) only the ones not checked recently."""
+    now = time.time()
+    stale = [policy_id for policy_id in set(policy_ids)
+             if policy_id not in BUNDLES or now - BUNDLES[policy_id].checked > POLICY_CHECK_SECS]
+    if stale:
+        for policy_doc in db.get_all([db.collection('policies').document(policy_id) for policy_id in stale]):
+            bundle = BUNDLES.get(policy_doc.id)
+            if bundle and policy_doc.exists and bundle.update_time == policy_doc.update_time:
+                bundle.checked = now
+            else:
+                logging.info('Building policy bundle {}'.format(policy_doc.id))
+                BUNDLES[policy_doc.id] = PolicyBundle.from_document(policy_doc)
+    return [BUNDLES[policy_id] for policy_id in policy_ids if policy_id in BUNDLES]
+
+
+def get_group_bundle(group_doc, db):
+    group = group_doc.to_dict()
+    bundles = get_bundles(group['policies'], db)
+    path = group_doc.reference.path
+    if path not in GROUP_BUNDLES or not GROUP_BUNDLES[path].is_valid(group_doc, bundles):
+        GROUP_BUNDLES[path] = GroupBundle(group_doc, bundles)
+    return GROUP_BUNDLES[path]
+
+
+def get_actions(groups, db, exclude_actions):
+    """Returns actions of all the groups, highest priority first, skipping excluded and duplicate action ids."""
+    ids = set(exclude_actions)
+    group_actions = []
+    for group_doc in groups:
+        group = group_doc.to_dict()
+        if 'policies' not in group:
+            continue
+        logging.info('Applying {} policies {}'.format(group['title'], group['policies']))
+        actions = []
+        for action in get_group_bundle(group_doc, db).actions:
+            if action['id'] not in ids:
+                actions.append(dict(action))
+                ids.add(action['id'])
+        group_actions.append(actions)
+    return list(heapq.merge(*group_actions, key=lambda action: action['priority'], reverse=True))
+
+
+class ConditionIndex(object):
+    """Index of simple condition requirements (intent, action, channel, member and coach flags etc.) to find the
+    candidate actions for a context without rendering their conditions."""
+    def __init__(self, actions):
+        self.ids = set()
+        self.never = set()
+        self.values = {}
+        self.truthy = {}
+        self.constrained = {}
+        for action in actions:
+            self.ids.add(action['id'])
+            requirements = get_requirements(action['condition']) if 'condition' in action else {}
+            if requirements is NEVER:
+                self.never.add(action['id'])
+                continue
+            for path, values in requirements.items():
+                self.constrained.setdefault(path, set()).add(action['id'])
+                for value in values:
+                    if value is TRUTHY:
+                        self.truthy.setdefault(path, set()).add(action['id'])
+                    else:
+                        self.values.setdefault(path, {}).setdefault(value, set()).add(action['id'])
+        self.paths = tuple(self.constrained.keys())
+        self.facts = None
+        self.candidates = None
+
+    def match(self, context):
+        """Returns ids of the actions whose conditions may be true for the current context."""
+        facts = tuple(get_fact(context.get(path)) for path in self.paths)
+        if facts == self.facts:
+            return self.candidates
+        candidates = self.ids - self.never
+        for path, (fact, truthy) in zip(self.paths, facts):
+            allowed = set(self.truthy.get(path, ())) if truthy else set()
+            if fact is not UNHASHABLE:
+                allowed.update(self.values.get(path, {}).get(fact, ()))
+            candidates -= self.constrained[path] - allowed
+        self.facts, self.candidates = facts, candidates
+        return candidates
+
+    def matches(self, action, context):
+        return action['id'] not in self.ids or action['id'] in self.match(context)
+
+
+def get_fact(value):
+    """Returns (value, truthiness) of a context value for matching. Values that can't be hashed can't equal condition
+    constants either, and values without a truth value (e.g. NumPy arrays of several numbers) count as truthy, so
+    the candidates still include every action whose condition may be true."""
+    try:
+        hash(value)
+    except TypeError:
+        value_key = UNHASHABLE
+    else:
+        value_key = value
+    try:
+        return value_key, bool(value)
+    except ValueError:
+        return value_key, True
+
+
+@functools.lru_cache(maxsize=4096)
+def get_requirements(condition):
+    """Returns {path: allowed values} that must hold for the condition to render True, NEVER if it can't, or an
+    empty dict if the condition is too complex to analyze."""
+    try:
+        template = ENVIRONMENT.parse(condition)
+    except:
+        return NEVER
+    if len(template.body) != 1 or type(template.body[0]) != nodes.Output:
+        return {}
+    output = template.body[0].nodes
+    if all(type(node) == nodes.TemplateData for node in output):
+        return {} if ''.join(node.data for node in output) == str(True) else NEVER
+    return get_expression_requirements(output[0]) if len(output) == 1 else {}
+
+
+def get_expression_requirements(node):
+    if type(node) == nodes.And:
+        left, right = get_expression_requirements(node.left), get_expression_requirements(node.right)
+        if left is NEVER or right is NEVER:
+            return NEVER
+        requirements = dict(left)
+        for path, values in right.items():
+            if path not in requirements or requirements[path] == {TRUTHY}:
+                requirements[path] = values
+            elif TRUTHY not in values and TRUTHY not in requirements[path]:
+                requirements[path] = requirements[path] & values
+        return requirements
+    elif type(node) == nodes.Or:
+        left, right = get_expression_requirements(node.left), get_expression_requirements(node.right)
+        if left is NEVER or right is NEVER:
+            return right if left is NEVER else left
+        return {path: left[path] | right[path] for path in left.keys() & right.keys()}
+    elif type(node) == nodes.Const:
+        return {} if node.value else NEVER
+    elif type(node) == nodes.Compare and len(node.ops) == 1:
+        path, operand = get_path(node.expr), node.ops[0]
+        if operand.op == 'eq' and not path:
+            path, operand = get_path(operand.expr), nodes.Operand('eq', node.expr)
+        if path and operand.op == 'eq' and type(operand.expr) == nodes.Const:
+            return {path: frozenset([operand.expr.value])}
+        if path and operand.op == 'in' and type(operand.expr) in [nodes.List, nodes.Tuple] \
+                and all(type(item) == nodes.Const for item in operand.expr.items):
+            return {path: frozenset(item.value for item in operand.expr.items)}
+    else:
+        path = get_path(node)
+        if path:
+            return {path: frozenset([TRUTHY])}
+    return {}
+
+
+def get_path(node):
+    """Returns dotted context path for a plain variable lookup like message.nlp.intent, None for anything else."""
+    tokens = []
+    while type(node) in [nodes.Getattr, nodes.Getitem]:
+        if type(node) == nodes.Getattr:
+            tokens.insert(0, node.attr)
+        elif type(node.arg) == nodes.Const and type(node.arg.value) == str:
+            tokens.insert(0, node.arg.value)
+        else:
+            return None
+        node = node.node
+    if type(node) != nodes.Name:
+        return None
+    tokens.insert(0, node.name)
+    # Context.get only resolves up to 4 levels and Jinja resolves dict attributes (e.g. items) before keys
+    if len(tokens) > 4 or tokens[0] in UNINDEXED_KEYS \
+            or any(token.isnumeric() or '.' in token or hasattr(dict, token) for token in tokens):
+        return None
+    return '.'.join(tokens)
@@ -1,19 +1,19 @@
 import base64
 import cipher
+import clients
 import config
 import datetime
 import dateutil.parser
 import json
 import logging
+import publishing
 import pytz
 import requests
 import uuid
 
 from generic import Action
 
-from google.cloud import pubsub_v1
 from urllib.parse import urlencode
-from google.cloud import firestore
 
 
 class DataProvider(Action):
@@ -28,13 +28,15 @@ class DataProvider(Action):
             response['expires'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=response['expires_in'])
             self.action_update.update(response)
 
-        publisher = pubsub_v1.PublisherClient()
-        topic_path = publisher.topic_path(config.PROJECT_ID, 'data')
         local_last_sync = last_sync
+        batch = publishing.Batch('data')
         for row in PROVIDERS[name](access_token, local_last_sync, source_id):
             row_time = dateutil.parser.parse(row['time']).astimezone(pytz.UTC)
             local_last_sync = max(row_time, local_last_sync) if local_last_sync else row_time
-            publisher.publish(topic_path, json.dumps(row).encode('utf-8'))
+            batch.publish(json.dumps(row).encode('utf-8'))
+        if batch.flush():
+            # Sync again from the same point next time instead of losing the readings that failed
+            return
 
         if not last_sync or (local_last_sync and last_sync < local_last_sync):
             self.action_update['last_sync'] = local_last_sync
@@ -158,7 +160,7 @@ class OAuth(Action):
 
     def process(self):
         short_code = base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b'=').decode('ascii')
-        db = firestore.Client()
+        db = clients.firestore()
         db.collection('urls').document(short_code).set({
             'redirect': PROVIDER_URLS[self.provider](self.person_id)
         })
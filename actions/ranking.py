@@ -0,0 +1,38 @@
+import numpy as np
+
+
+class TicketTable(object):
+    """Open tickets of many persons as columns (person index, priority), with the tickets of a person stored
+    next to each other so per person aggregates are computed with grouped NumPy operations."""
+    def __init__(self, open_tickets):
+        self.tickets = []
+        counts = []
+        for tickets in open_tickets.values():
+            if tickets:
+                self.tickets.extend(tickets.values())
+                counts.append(len(tickets))
+        self.counts = np.array(counts, dtype=np.int64)
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1])).astype(np.int64)
+        self.persons = np.repeat(np.arange(len(counts)), self.counts)
+        self.priorities = np.fromiter((ticket['priority'] if ticket['priority'] else 0 for ticket in self.tickets),
+                                      dtype=np.float64, count=len(self.tickets))
+
+    def get_times(self, indices):
+        return np.array([self.tickets[i]['time'] if 'time' in self.tickets[i] and self.tickets[i]['time'] else ''
+                         for i in indices], dtype=str)
+
+    def get_top_persons(self):
+        """Returns the highest priority ticket of each person with a ticket of the highest priority overall, ordered
+        by the sum of the priorities of the person, the earliest ticket first if a person has several."""
+        if not self.tickets:
+            return []
+        sums = np.add.reduceat(self.priorities, self.starts)
+        top = np.flatnonzero(self.priorities == self.priorities.max())
+        top = top[np.lexsort((self.get_times(top), self.persons[top]))]
+        persons, first = np.unique(self.persons[top], return_index=True)
+        order = np.argsort(-sums[persons], kind='stable')
+        return [self.tickets[i] for i in top[first][order]]
+
+
+def get_tickets_from_top_persons(open_tickets):
+    return TicketTable(open_tickets).get_top_persons()
@@ -1,15 +1,21 @@
+import clients
 import common
 import config
 import datetime
 import json
 import logging
-import numpy as np
+import queries
+import ranking
+import time
 
-from google.cloud import bigquery
+from generic import Action
 from google.cloud import firestore
-from google.cloud import pubsub_v1
 
-from generic import Action
+
+# Value or number of the data item of given name in a tsdata row
+DATA_SQL = '(SELECT {} FROM UNNEST(data) WHERE name = {})'
+# Tickets of persons whose ticket document changed recently may not be in BigQuery yet, so they are not reconciled
+RECONCILE_MARGIN_SECS = 10 * 60
 
 
 class List(Action):
@@ -18,19 +24,16 @@ class List(Action):
             logging.error('Missing person_id or parent_id for list tickets')
             return
 
-        db = firestore.Client()
-        sources = []
+        db = clients.firestore()
+        person_ids = []
         if person_id:
-            sources.append(person_id['value'])
+            person_ids.append(person_id)
         elif parent_id:
-            for person_id in common.get_children_ids(parent_id, 'member', db):
-                person_doc = db.collection(common.COLLECTIONS[person_id['type']]).document(person_id['value']).get()
-                person = person_doc.to_dict() if person_doc.exists else {}
-                if 'pause_time' not in person:
-                    sources.append(person_id['value'])
-
-        tickets = self.get_tickets_from_top_persons(self.get_open_tickets(sources)) if parent_id \
-            else self.get_top_tickets_from_person(self.get_open_tickets(sources), sources[0])
+            person_ids = [person_id for person_id, person in get_members(parent_id, db) if 'pause_time' not in person]
+
+        open_tickets = get_open_tickets(person_ids, db)
+        tickets = self.get_tickets_from_top_persons(open_tickets) if parent_id \
+            else self.get_top_tickets_from_person(open_tickets, person_ids[0]['value'])
         self.context_update = {'tickets': tickets}
 
     @staticmethod
@@ -39,46 +42,28 @@ class List(Action):
 
     @staticmethod
     def get_tickets_from_top_persons(open_tickets):
-        person_data = []
-        max_priority = 0
-        for person, tickets in open_tickets.items():
-            if not tickets:
-                continue
-            person_data.append({'max': np.max([t['priority'] for t in tickets.values()]),
-                                'sum': np.sum([t['priority'] for t in tickets.values()]),
-                                'ticket': sorted(tickets.values(), key=lambda t: t['priority'], reverse=True)[0]})
-            max_priority = max(person_data[-1]['max'], max_priority)
-        return list(map(lambda p: p['ticket'], sorted(filter(lambda p: p['max'] >= max_priority, person_data),
-                                                      key=lambda p: p['sum'], reverse=True)))
+        return ranking.get_tickets_from_top_persons(open_tickets)
 
-    @staticmethod
-    def get_open_tickets(sources):
-        bq = bigquery.Client()
-        q = 'SELECT time, source, id, priority, status, category, title FROM (' \
-            'SELECT time, source, ' \
-            '(select number FROM UNNEST(data) WHERE name = "id") as id, '\
-            '(select value FROM UNNEST(data) WHERE name = "id") as status, '\
-            '(select number FROM UNNEST(data) WHERE name = "priority") as priority, ' \
-            '(select value FROM UNNEST(data) WHERE name = "category") as category, '\
-            '(select value FROM UNNEST(data) WHERE name = "title") as title ' \
-            'FROM {project}.live.tsdata '\
-            'WHERE source.value IN ("{sources}") AND "ticket" IN UNNEST(tags)) '\
-            'ORDER BY time'.format(project=config.PROJECT_ID, sources='","'.join(sources))
-        logging.info(q)
-        tickets = {person: {} for person in sources}
-        for row in bq.query(q):
-            person = row['source']['value']
-            ticket_id = int(row['id'])
-            if row['status'] == 'opened':
-                tickets[person][ticket_id] = {'person_id': row['source'], 'id': ticket_id, 'title': row['title'],
-                                              'priority': row['priority'] if row['priority'] else 0,
-                                              'time': row['time'].isoformat(), 'category': row['category']}
-            elif row['status'] == 'closed':
-                if ticket_id not in tickets[person]:
-                    logging.warning('Ticket {} for {} closed before opening'.format(ticket_id, person))
-                    continue
-                del tickets[person][ticket_id]
-        return tickets
+
+class Reconcile(Action):
+    """Rebuilds the open tickets of the person or the members of the parent from the ticket history in BigQuery."""
+    def process(self, person_id=None, parent_id=None, margin_secs=RECONCILE_MARGIN_SECS):
+        if (not person_id or 'value' not in person_id) and (not parent_id or 'value' not in parent_id):
+            logging.error('Missing person_id or parent_id for reconcile tickets')
+            return
+
+        db = clients.firestore()
+        person_ids = [person_id] if person_id else [person_id for person_id, _ in get_members(parent_id, db)]
+        if not person_ids:
+            return
+        history = replay_tickets([person_id['value'] for person_id in person_ids])
+        changed = []
+        for person_id in person_ids:
+            if reconcile_tickets(db.transaction(), get_tickets_ref(person_id, db), history[person_id['value']],
+                                 margin_secs):
+                changed.append(person_id)
+        logging.info('Reconciled tickets of {} persons, {} changed'.format(len(person_ids), len(changed)))
+        self.context_update = {'reconciled': changed}
 
 
 class Operation(Action):
@@ -91,12 +76,12 @@ class Operation(Action):
         if not person_id:
             logging.error('Missing person_id for ticket operation')
             return
+        db = clients.firestore()
+        now = datetime.datetime.utcnow().isoformat()
         if self.status == 'opened':
-            rows = bigquery.Client().query(
-                'SELECT count(*) as count FROM {project}.live.tsdata, UNNEST(data) '\
-                'WHERE source.value = "{source}" AND "ticket" IN UNNEST(tags) AND value = "opened" '\
-                .format(project=config.PROJECT_ID, source=person_id['value'])).result()
-            ticket_id = list(rows)[0]['count'] + 1
+            priority = get_priority(priority)
+            ticket_id = open_ticket(person_id, {'person_id': person_id, 'title': content, 'priority': priority,
+                                                'time': now, 'category': category}, db)
         elif not ticket_id:
             for tag in id_tags:
                 try:
@@ -110,11 +95,13 @@ class Operation(Action):
 
         if ticket_id and type(ticket_id) == str:
             ticket_id = int(ticket_id)
+        if self.status == 'closed':
+            close_ticket(person_id, ticket_id, db)
 
-        publisher = pubsub_v1.PublisherClient()
+        publisher = clients.publisher()
         topic_path = publisher.topic_path(config.PROJECT_ID, 'data')
         row = {
-            'time': datetime.datetime.utcnow().isoformat(),
+            'time': now,
             'source': person_id,
             'tags': ['ticket'],
             'data': [{'name': 'id', 'number': ticket_id, 'value': self.status}]
@@ -138,3 +125,129 @@ class Open(Operation):
 class Close(Operation):
     def __init__(self):
         super().__init__('closed')
+
+
+def get_priority(priority):
+    """Returns the priority as a number, as open tickets are ranked by it and rendered params are strings."""
+    if not priority:
+        return 0
+    try:
+        return int(float(priority))
+    except (TypeError, ValueError, OverflowError):
+        logging.warning('Invalid ticket priority {}, using 0'.format(priority))
+        return 0
+
+
+def get_tickets_ref(person_id, db):
+    return db.document('tickets/{type}:{value}'.format(type=person_id['type'], value=person_id['value']))
+
+
+def open_ticket(person_id, ticket, db):
+    """Allocates the next ticket id of the person and adds the ticket to the open tickets in one transaction. The
+    first ticket of a person seeds the counter and the open tickets from the ticket history in BigQuery."""
+    ref = get_tickets_ref(person_id, db)
+    seed = None
+    if not ref.get().exists:
+        seed = replay_tickets([person_id['value']])[person_id['value']]
+        logging.info('Seeding tickets of {} with {} tickets'.format(person_id, seed['count']))
+    return add_open_ticket(db.transaction(), ref, ticket, seed)
+
+
+@firestore.transactional
+def add_open_ticket(transaction, ref, ticket, seed):
+    doc = ref.get(transaction=transaction)
+    tickets = doc.to_dict() if doc.exists else seed if seed else {}
+    ticket_id = (tickets['count'] if 'count' in tickets else 0) + 1
+    opened = dict(tickets['open']) if 'open' in tickets and not doc.exists else {}
+    opened[str(ticket_id)] = ticket | {'id': ticket_id}
+    transaction.set(ref, {'count': ticket_id, 'open': opened}, merge=True)
+    return ticket_id
+
+
+def get_open_tickets(person_ids, db):
+    """Returns {person: {id: ticket}} from the ticket documents of the persons, seeding the missing documents from the
+    ticket history in BigQuery."""
+    tickets = {}
+    for doc in db.get_all([get_tickets_ref(person_id, db) for person_id in person_ids]):
+        if doc.exists:
+            opened = doc.get('open') if 'open' in doc.to_dict() else {}
+            tickets[doc.id.split(':', 1)[1]] = {int(ticket_id): ticket for ticket_id, ticket in opened.items()}
+    missing = [person_id for person_id in person_ids if person_id['value'] not in tickets]
+    if missing:
+        logging.info('Seeding tickets of {} persons'.format(len(missing)))
+        history = replay_tickets([person_id['value'] for person_id in missing])
+        batch = db.batch()
+        for person_id in missing:
+            batch.create(get_tickets_ref(person_id, db), history[person_id['value']])
+            tickets[person_id['value']] = {int(ticket_id): ticket
+                                           for ticket_id, ticket in history[person_id['value']]['open'].items()}
+        try:
+            batch.commit()
+        except:
+            logging.warning('Tickets already exist for some of {}'.format(missing))
+    return tickets
+
+
+def close_ticket(person_id, ticket_id, db):
+    try:
+        get_tickets_ref(person_id, db).update({'open.{}'.format(ticket_id): firestore.DELETE_FIELD})
+    except:
+        logging.warning('No open tickets of {} to close {}'.format(person_id, ticket_id))
+
+
+@firestore.transactional
+def reconcile_tickets(transaction, ref, history, margin_secs):
+    """Replaces the open tickets of the document with the replayed ones, unless the document changed within the
+    margin. Returns True if the open tickets changed."""
+    doc = ref.get(transaction=transaction)
+    tickets = doc.to_dict() if doc.exists else {}
+    if doc.exists and time.time() - doc.update_time.timestamp() < margin_secs:
+        logging.info('Skipping recently changed tickets {}'.format(ref.id))
+        return False
+    opened = tickets['open'] if 'open' in tickets else {}
+    count = max(tickets['count'] if 'count' in tickets else 0, history['count'])
+    if doc.exists and opened.keys() == history['open'].keys() and 'count' in tickets and count == tickets['count']:
+        return False
+    logging.warning('Reconciling tickets {} {} to {}'.format(ref.id, sorted(opened.keys()),
+                                                             sorted(history['open'].keys())))
+    transaction.set(ref, {'count': count, 'open': history['open']})
+    return True
+
+
+def get_members(parent_id, db):
+    """Returns (member id, member) of the members of the parent, reading the member documents in one batch."""
+    member_ids = {'{}/{}'.format(common.COLLECTIONS[member_id['type']], member_id['value']): member_id
+                  for member_id in common.get_children_ids(parent_id, 'member', db)}
+    if not member_ids:
+        return []
+    return [(member_ids[doc.reference.path], doc.to_dict() if doc.exists else {})
+            for doc in db.get_all([db.document(path) for path in member_ids.keys()])]
+
+
+def replay_tickets(sources):
+    """Replays the ticket events of the persons and returns {person: {'count': opened tickets, 'open': {id: ticket}}}.
+    The whole history is read, as the count continues the ticket ids of the first ticket of the person."""
+    query = queries.Query('tsdata', ['time', 'source', DATA_SQL.format('number', '"id"') + ' AS id',
+                                     DATA_SQL.format('value', '"id"') + ' AS status',
+                                     DATA_SQL.format('number', '"priority"') + ' AS priority',
+                                     DATA_SQL.format('value', '"category"') + ' AS category',
+                                     DATA_SQL.format('value', '"title"') + ' AS title'], None)
+    query.where('source.value IN UNNEST({})', sources)
+    query.where('{} IN UNNEST(tags)', 'ticket')
+    query.order_by('time')
+    history = {person: {'count': 0, 'open': {}} for person in sources}
+    for row in query.run():
+        person = row['source']['value']
+        ticket_id = int(row['id'])
+        tickets = history[person]['open']
+        if row['status'] == 'opened':
+            history[person]['count'] = max(history[person]['count'] + 1, ticket_id)
+            tickets[str(ticket_id)] = {'person_id': row['source'], 'id': ticket_id, 'title': row['title'],
+                                       'priority': row['priority'] if row['priority'] else 0,
+                                       'time': row['time'].isoformat(), 'category': row['category']}
+        elif row['status'] == 'closed':
+            if str(ticket_id) not in tickets:
+                logging.warning('Ticket {} for {} closed before opening'.format(ticket_id, person))
+                continue
+            del tickets[str(ticket_id)]
+    return history
@@ -0,0 +1 @@
+../clients.py
\ No newline at end of file
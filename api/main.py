@@ -1,23 +1,29 @@
 import base64
+import clients
 import common
 import config
 import datetime
 import dateutil.parser
 import json
 import flask
+import itertools
 import logging
+import queries
+import recent
+import sink
 import uuid
 
-from google.cloud import bigquery
-from google.cloud import firestore
-from google.cloud import pubsub_v1
-
 from common import COLLECTIONS
 
 import google.cloud.logging as logger
 logger.handlers.setup_logging(logger.Client().get_default_handler())
 
 JSON_CACHE_SECONDS = 600
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Query jobs of message pages are kept in pages documents for this long, within the day BigQuery keeps their results
+PAGES_SECONDS = 12 * 60 * 60
+LOG_BUFFER = sink.BackgroundBuffer('log')
 ALLOW_HEADERS = ['Accept', 'Authorization', 'Cache-Control', 'Content-Type', 'Cookie', 'Expires', 'Origin', 'Pragma',
                  'Access-Control-Allow-Headers', 'Access-Control-Request-Method', 'Access-Control-Request-Headers',
                  'Access-Control-Allow-Credentials', 'X-Requested-With']
@@ -49,25 +55,22 @@ def main(request):
         return response
     logging.info('{} /{}/{}/{}/{}'.format(request.method, resource_name, resource_id,
                                           sub_resource_name, sub_resource_id))
-    log = {'time': datetime.datetime.utcnow().isoformat(), 'type': 'api.' + request.method.lower(),
-           'resources': [{'type': resource_name, 'value': resource_id}]}
-    if sub_resource_id:
-        log['resources'].append({'type': sub_resource_name, 'value': sub_resource_id if sub_resource_id else ''})
-    errors = bigquery.Client().insert_rows_json('%s.live.log' % config.PROJECT_ID, [log])
-    if errors:
-        logging.warning(errors)
 
     # TODO: Check authorization
-    db = firestore.Client()
+    db = clients.firestore()
     try:
         auth_token = request.headers['Authorization'].split(' ')[1]
-        user = list(db.collection('persons').where('login.token', '==', auth_token).get())[0]
-        if not user:
-            raise Exception
+        user_id = common.get_session_person_id(auth_token, db)['value']
     except:
         response.status_code = 401
         return response
 
+    log = {'time': datetime.datetime.utcnow().isoformat(), 'type': 'api.' + request.method.lower(),
+           'resources': [{'type': resource_name, 'value': resource_id}]}
+    if sub_resource_id:
+        log['resources'].append({'type': sub_resource_name, 'value': sub_resource_id if sub_resource_id else ''})
+    LOG_BUFFER.add([log])
+
     if not resource_name:
         response.status_code = 400
         return response
@@ -79,24 +82,52 @@ def main(request):
 
     doc = None
     if request.method == 'GET' and sub_resource_name in ['member', 'admin']:
-        doc = list_resources(resource_name, resource_id, sub_resource_name, sub_resource_id)
+        cursor = request.args.get('cursor')
+        if cursor and not is_relation_path(cursor, resource_name, resource_id, sub_resource_name, sub_resource_id):
+            response.status_code = 400
+            return response
+        # Listings are only paged for clients asking for pages, older clients get all the relations
+        paged = cursor or 'page_size' in request.args
+        doc = list_resources(resource_name, resource_id, sub_resource_name, sub_resource_id,
+                             get_page_size(request) if paged else None, cursor)
     elif request.method == 'GET' and resource_name == 'person' and sub_resource_name == 'data' and resource_id:
         doc = {'results': []}
+        resolution = request.args.get('resolution', 'raw')
+        if resolution != 'raw' and resolution not in queries.RESOLUTIONS:
+            response.status_code = 400
+            return response
         if request.args.getlist('name'):
             start_time, end_time = get_start_end_times(request)
-            doc['results'] = get_data_by_names(start_time, end_time, resource_id, request.args.getlist('name'))
+            doc['results'] = get_data_by_names(start_time, end_time, resource_id, request.args.getlist('name'),
+                                               resolution)
         elif request.args.get('tag'):
             doc['results'] = get_data_by_tag(resource_id, request.args.get('tag'))
     elif request.method == 'GET' and resource_id and sub_resource_name and not sub_resource_id:
-        doc = get_resources(resource_name, resource_id, sub_resource_name, db)
+        page_token = request.args.get('page_token')
+        doc = get_resources(resource_name, resource_id, sub_resource_name, db) if not page_token else {'results': []}
         if resource_name == 'person' and sub_resource_name == 'message':
             for qmessage in doc['results']:
                 qmessage['status'] = 'queued'
             start_time, end_time = get_start_end_times(request)
-            doc['results'].extend(get_messages(start_time, end_time, resource_id, request.args.get('both'),
-                                               request.args.get('tag')))
+            query_args = (start_time, end_time, resource_id, request.args.get('both'), request.args.get('tag'))
+            if request.args.get('format') == 'ndjson':
+                messages = stream_messages(*query_args, get_page_size(request))
+                response.response = itertools.chain((json.dumps(qmessage, default=str) + '\n'
+                                                     for qmessage in doc['results']), messages)
+                response.headers['Content-Type'] = 'application/x-ndjson'
+                return response
+            elif page_token or 'page_size' in request.args:
+                page = get_messages_page(*query_args, get_page_size(request), user_id, page_token)
+                if page is None:
+                    response.status_code = 400
+                    return response
+                doc['results'].extend(page['results'])
+                if 'page_token' in page:
+                    doc['page_token'] = page['page_token']
+            else:
+                doc['results'].extend(get_messages(*query_args))
     elif request.method == 'GET' and resource_id:
-        resource_id = user.id if resource_id == 'me' else resource_id
+        resource_id = user_id if resource_id == 'me' else resource_id
         doc = get_resource(resource_name, resource_id, sub_resource_name, sub_resource_id, db)
     elif request.method == 'PATCH' and resource_id:
         doc = update_resource(resource_name, resource_id, sub_resource_name, sub_resource_id, request.json, db)
@@ -106,9 +137,9 @@ def main(request):
         if sub_resource_name in ['member', 'admin'] and resource_id:
             doc = add_relation(resource_name, resource_id, sub_resource_name, request.json)
         elif sub_resource_name == 'message' and resource_id:
-            doc = send_message(resource_id, request.json, user)
+            doc = send_message(resource_id, request.json, user_id)
         else:
-            doc = add_resource(resource_name, resource_id, sub_resource_name, request.json, user.id, db)
+            doc = add_resource(resource_name, resource_id, sub_resource_name, request.json, user_id, db)
 
     if doc:
         response = flask.jsonify(doc)
@@ -123,32 +154,58 @@ def main(request):
     return response
 
 
-def list_resources(resource_name, resource_id, sub_resource_name, sub_resource_id):
-    results = []
-    db = firestore.Client()
-    if sub_resource_id and (not resource_id or resource_id in ['any', 'all']):
+def list_resources(resource_name, resource_id, sub_resource_name, sub_resource_id, page_size=None, cursor=None):
+    """Returns the parents or children, or a page of them with the cursor to the next page if there may be more."""
+    db = clients.firestore()
+    parents = sub_resource_id and (not resource_id or resource_id in ['any', 'all'])
+    if parents:
         # Get all the parents of the sub_resource_name:sub_resource_id
         relation_query = db.collection_group(COLLECTIONS[sub_resource_name]).where('id.value', '==', sub_resource_id)
-        for relative in relation_query.stream():
-            parent = relative.reference.parent.parent.get()
-            parent_type = parent.reference.path.split('/')[0][:-1]
-            if parent_type != resource_name:
-                continue
-            results.append(get_document_json(parent))
     elif resource_id and (not sub_resource_id or sub_resource_id in ['any', 'all']):
         # Get all the children
         relation_query = db.collection(COLLECTIONS[resource_name]).document(resource_id)\
             .collection(COLLECTIONS[sub_resource_name])
-        for doc in relation_query.stream():
-            relative = db.collection(COLLECTIONS[doc.get('id.type')]).document(doc.get('id.value')).get()
-            results.append(get_document_json(doc) | get_document_json(relative))
-    return {'results': results}
+    else:
+        return {'results': []}
+    relation_query = relation_query.order_by('__name__')
+    if page_size:
+        relation_query = relation_query.limit(page_size)
+    if cursor:
+        relation_query = relation_query.start_after({'__name__': db.document(cursor)})
+    relations = list(relation_query.stream())
+
+    if parents:
+        refs = [relation.reference.parent.parent for relation in relations
+                if relation.reference.parent.parent.path.split('/')[0][:-1] == resource_name]
+        docs = {doc.reference.path: doc for doc in db.get_all(refs)} if refs else {}
+        results = [get_document_json(docs[ref.path]) for ref in refs if ref.path in docs]
+    else:
+        refs = [db.collection(COLLECTIONS[relation.get('id.type')]).document(relation.get('id.value'))
+                for relation in relations]
+        docs = {doc.reference.path: doc for doc in db.get_all(refs)} if refs else {}
+        results = [get_document_json(relation) | (get_document_json(docs[ref.path]) if ref.path in docs else {})
+                   for relation, ref in zip(relations, refs)]
+    page = {'results': results}
+    if page_size and len(relations) == page_size:
+        page['cursor'] = relations[-1].reference.path
+    return page
+
+
+def is_relation_path(path, resource_name, resource_id, sub_resource_name, sub_resource_id):
+    """Returns whether the path (e.g. a cursor) is of a relation document listed by list_resources: a child of the
+    resource or, when listing the parents of the sub resource, a relation of its type under any parent."""
+    tokens = path.split('/')
+    if len(tokens) < 4 or len(tokens) % 2 or not all(tokens) or tokens[-2] != COLLECTIONS[sub_resource_name]:
+        return False
+    if sub_resource_id and (not resource_id or resource_id in ['any', 'all']):
+        return True
+    return tokens[:-1] == [COLLECTIONS[resource_name], resource_id, COLLECTIONS[sub_resource_name]]
 
 
 def add_relation(resource_name, resource_id, sub_resource_name, identifier):
     if 'type' not in identifier or 'value' not in identifier:
         return None
-    db = firestore.Client()
+    db = clients.firestore()
     data = common.add_child(identifier, {'type': resource_name, 'value': resource_id}, sub_resource_name, db)
     return {'status': 'ok'} if data else None
 
@@ -170,17 +227,26 @@ def update_resource(resource_name, resource_id, sub_resource_name, sub_resource_
     doc_ref = db.collection(COLLECTIONS[resource_name]).document(resource_id)
     if sub_resource_name and sub_resource_id:
         doc_ref = doc_ref.collection(COLLECTIONS[sub_resource_name]).document(sub_resource_id)
-    elif resource_name == 'person' and 'identifiers' in resource:
-        # Check if the new identifiers exist for someone else
-        for person in db.collection('persons')\
-                .where('identifiers', 'array_contains_any', resource['identifiers']).stream():
-            if person.reference.path != doc_ref.path:
-                return None
+    elif resource_name in ['person', 'group'] and 'identifiers' in resource:
+        # Claim the new identifiers in the identifiers index, failing if they exist for someone else
+        identified_id = {'type': resource_name, 'value': resource_id}
+        if common.add_identifiers(identified_id, resource['identifiers'], db):
+            return None
+        doc = doc_ref.get()
+        previous = doc.get('identifiers') if doc.exists and 'identifiers' in doc.to_dict() else []
+        common.remove_identifiers(identified_id, [identifier for identifier in previous
+                                                  if identifier not in resource['identifiers']], db)
+    resource.pop('parents', None)
     doc_ref.update(resource)
     return get_document_json(doc_ref.get())
 
 
 def delete_resource(resource_name, resource_id, sub_resource_name, sub_resource_id, db):
+    if sub_resource_name in common.RELATION_TYPES and ':' in sub_resource_id:
+        child_type, child_value = sub_resource_id.split(':', 1)
+        common.remove_child({'type': child_type, 'value': child_value}, {'type': resource_name, 'value': resource_id},
+                            sub_resource_name, db)
+        return {'status': 'ok'}
     db.collection(COLLECTIONS[resource_name]).document(resource_id)\
         .collection(COLLECTIONS[sub_resource_name]).document(sub_resource_id).delete()
     return {'status': 'ok'}
@@ -192,30 +258,33 @@ def add_resource(resource_name, resource_id, sub_resource_name, resource, user_i
         collection = collection.document(resource_id).collection(COLLECTIONS[sub_resource_name])
 
     if resource_name == 'person' and not sub_resource_name:
-        person_ref = db.collection('persons') \
-            .where('identifiers', 'array_contains_any', resource['identifiers'])
-        persons = list(person_ref.get())
-        if len(persons) > 0:
-            return get_document_json(persons[0])
+        for identifier in resource['identifiers']:
+            person_doc = common.get_identified_doc(identifier, db, ['person'])
+            if person_doc:
+                return get_document_json(person_doc)
     doc_id = generate_id()
     doc_ref = collection.document(doc_id)
+    if resource_name in ['person', 'group'] and not sub_resource_name and 'identifiers' in resource \
+            and common.add_identifiers({'type': resource_name, 'value': doc_id}, resource['identifiers'], db):
+        return None
+    resource.pop('parents', None)
     doc_ref.set(resource)
     if resource_name == 'group' and not resource_id:
-        db.collection(COLLECTIONS[resource_name]).document(doc_id).collection('admins')\
-            .document('person:' + user_id).set({'id': {'type': 'person', 'value': user_id}})
+        common.add_child({'type': 'person', 'value': user_id}, {'type': resource_name, 'value': doc_id}, 'admin', db)
     return get_document_json(doc_ref.get())
 
 
-def get_data_by_names(start_time, end_time, source, names):
-    bq = bigquery.Client()
-    query = 'SELECT time, duration, name, number, value ' \
-            'FROM {project}.live.tsdata, UNNEST(data) WHERE source.value = "{source}" AND name IN ({names}) ' \
-            'AND TIMESTAMP("{start}") < time AND time < TIMESTAMP("{end}") ' \
-            'ORDER BY time'. \
-        format(project=config.PROJECT_ID, source=source, names=str(names)[1:-1], start=start_time, end=end_time)
-    logging.info(query)
+def get_data_by_names(start_time, end_time, source, names, resolution='raw'):
+    if resolution in queries.RESOLUTIONS:
+        return get_rollups(start_time, end_time, source, names, resolution)
+    cached = recent.get_data(source, names, start_time, end_time, clients.firestore())
+    if cached is not None:
+        return [row | {'time': row['time'].isoformat()} for row in cached]
+    query = queries.Query('tsdata', ['time', 'duration', 'name', 'number', 'value'], start_time, end_time,
+                          unnest_data=True)
+    query.where('source.value = {}', source).where('name IN UNNEST({})', names).order_by('time')
     rows = []
-    for row in bq.query(query):
+    for row in query.run():
         rows.append({'time': row['time'].isoformat(),
                      'duration': row['duration'],
                      'name': row['name'],
@@ -224,48 +293,101 @@ def get_data_by_names(start_time, end_time, source, names):
     return rows
 
 
+def get_rollups(start_time, end_time, source, names, resolution):
+    return [queries.get_rollup_row(row, resolution)
+            for row in queries.get_rollup_query(source, names, start_time, end_time, resolution).run()]
+
+
 def get_data_by_tag(source, tag):
-    bq = bigquery.Client()
-    query = '''SELECT time, data
-               FROM {project}.live.tsdata WHERE source.value = "{source}" AND "{tag}" IN UNNEST(tags)
-               ORDER BY time'''.format(project=config.PROJECT_ID, source=source, tag=tag)
-    logging.info(query)
+    query = queries.Query('tsdata', ['time', 'data'], queries.history_start())
+    query.where('source.value = {}', source).where('{} IN UNNEST(tags)', tag).order_by('time')
     rows = []
-    for row in bq.query(query):
+    for row in query.run():
         rows.append({'time': row['time'].isoformat(), 'data': row['data']})
     return rows
 
 
-def get_messages(start_time, end_time, person_id, both, tag):
-    bq = bigquery.Client()
-    db = firestore.Client()
+def get_messages_query(start_time, end_time, person_id, both, tag):
+    db = clients.firestore()
     person_doc = db.collection('persons').document(person_id).get()
     values = [i['value'] for i in person_doc.get('identifiers')]
     values.append(person_doc.id)
-    query = 'SELECT time, status, sender, receiver, tags, content, content_type '\
-            + 'FROM {project}.live.messages WHERE '\
-            + ('(sender.value IN ({values}) OR receiver.value IN ({values})) '
-               if both else 'sender.value IN ({values}) ')\
-            + 'AND TIMESTAMP("{start}") < time AND time < TIMESTAMP("{end}") '\
-            + 'AND "source:schedule" NOT IN UNNEST(tags) '\
-            + ('AND "{tag}" IN UNNEST(tags) ' if tag else '')\
-            + 'ORDER BY time'
-    query = query.format(project=config.PROJECT_ID, values=str(values)[1:-1], start=start_time, end=end_time, tag=tag)
-    logging.info(query)
-    rows = []
-    for row in bq.query(query):
-        rows.append({'time': row['time'].isoformat(),
-                     'status': row['status'],
-                     'sender': row['sender'],
-                     'receiver': row['receiver'],
-                     'tags': row['tags'],
-                     'content': row['content'],
-                     'content_type': row['content_type']})
-    return rows
+    query = queries.Query('messages', ['time', 'status', 'sender', 'receiver', 'tags', 'content', 'content_type'],
+                          start_time, end_time)
+    if both:
+        query.where('(sender.value IN UNNEST({}) OR receiver.value IN UNNEST({}))', values, values)
+    else:
+        query.where('sender.value IN UNNEST({})', values)
+    query.where('{} NOT IN UNNEST(tags)', 'source:schedule')
+    if tag:
+        query.where('{} IN UNNEST(tags)', tag)
+    return query.order_by('time')
+
+
+def get_message_json(row):
+    return {'time': row['time'].isoformat(),
+            'status': row['status'],
+            'sender': row['sender'],
+            'receiver': row['receiver'],
+            'tags': row['tags'],
+            'content': row['content'],
+            'content_type': row['content_type']}
+
+
+def get_messages(start_time, end_time, person_id, both, tag):
+    return [get_message_json(row) for row in get_messages_query(start_time, end_time, person_id, both, tag).run()]
+
+
+def get_messages_page(start_time, end_time, person_id, both, tag, page_size, user_id, page_token=None):
+    """Returns a page of messages and the token of the next page, None if the page token is invalid. Later pages are
+    read from the results of the query job of the first page, so they are consistent with it and don't run the query
+    again. The job is kept in a pages document of the user and query, so tokens can't read other query results."""
+    bq = clients.bigquery()
+    db = clients.firestore()
+    query_key = {'user': user_id, 'person': person_id, 'both': both, 'tag': tag}
+    if page_token:
+        token = get_page_token(page_token)
+        pages_doc = db.collection('pages').document(token['id']).get() if token else None
+        if not pages_doc or not pages_doc.exists or pages_doc.get('query') != query_key \
+                or pages_doc.get('expiry') < datetime.datetime.now(datetime.timezone.utc):
+            logging.warning('Invalid page token {}'.format(page_token))
+            return None
+        job = bq.get_job(pages_doc.get('job'), location=pages_doc.get('location'))
+    else:
+        token = {'id': generate_id()}
+        job = get_messages_query(start_time, end_time, person_id, both, tag).run(bq)
+    rows = bq.list_rows(job.destination, page_size=page_size, page_token=token['page'] if 'page' in token else None)
+    page = {'results': [get_message_json(row) for row in next(rows.pages, [])]}
+    if rows.next_page_token:
+        if not page_token:
+            db.collection('pages').document(token['id']).set({
+                'query': query_key, 'job': job.job_id, 'location': job.location,
+                'expiry': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=PAGES_SECONDS)})
+        page['page_token'] = base64.urlsafe_b64encode(json.dumps({
+            'id': token['id'], 'page': rows.next_page_token}).encode('utf-8')).decode('ascii')
+    return page
+
+
+def get_page_token(page_token):
+    """Returns the decoded page token, None if it can't be decoded."""
+    try:
+        token = json.loads(base64.urlsafe_b64decode(page_token.encode('ascii')))
+    except (ValueError, UnicodeError):
+        return None
+    if type(token) != dict or type(token.get('id')) != str or type(token.get('page')) != str or not token['id'] \
+            or '/' in token['id']:
+        return None
+    return token
+
 
+def stream_messages(start_time, end_time, person_id, both, tag, page_size):
+    """Yields messages as JSON lines, holding only one page of query results in memory at a time."""
+    for row in get_messages_query(start_time, end_time, person_id, both, tag).run().result(page_size=page_size):
+        yield json.dumps(get_message_json(row), default=str) + '\n'
 
-def send_message(person_id, message, user):
-    db = firestore.Client()
+
+def send_message(person_id, message, user_id):
+    db = clients.firestore()
     person_doc = db.collection('persons').document(person_id).get()
     if 'receiver' in message and message['receiver'] not in person_doc.to_dict()['identifiers'] \
             and message['receiver'] != {'type': 'person', 'value': person_id}:
@@ -275,11 +397,11 @@ def send_message(person_id, message, user):
     if not receiver:
         logging.warning('Missing receiver')
         return {'message': 'Missing receiver'}
-    publisher = pubsub_v1.PublisherClient()
+    publisher = clients.publisher()
     topic_path = publisher.topic_path(config.PROJECT_ID, 'message')
     data = {
         'time': datetime.datetime.utcnow().isoformat(),
-        'sender': {'type': 'person', 'value': user.id},
+        'sender': {'type': 'person', 'value': user_id},
         'receiver': receiver,
         'status': 'sent' if 'status' not in message else message['status'],
         'tags': message['tags'] if 'tags' in message else ['source:api'],
@@ -293,6 +415,13 @@ def send_message(person_id, message, user):
     return {'message': 'ok'}
 
 
+def get_page_size(request):
+    try:
+        return max(1, min(int(request.args.get('page_size', PAGE_SIZE)), MAX_PAGE_SIZE))
+    except ValueError:
+        return PAGE_SIZE
+
+
 def get_start_end_times(request):
     start_time = request.args.get('start')
     start_time = dateutil.parser.parse(start_time) \
@@ -308,6 +437,9 @@ def get_document_json(doc):
         return {}
     if 'login' in doc_json:
         del doc_json['login']
+    # Parents are denormalized from the relations for internal lookups, relations are listed with member and admin
+    if 'parents' in doc_json:
+        del doc_json['parents']
     doc_json['id'] = {'type': doc.reference.path.split('/')[0][:-1], 'value': doc.id}
     return doc_json
 
@@ -1,4 +1,5 @@
 import base64
+import clients
 import config
 import common
 import cipher
@@ -11,10 +12,6 @@ import random
 import requests
 import uuid
 
-from google.cloud import firestore
-from google.cloud import pubsub_v1
-from google.cloud import tasks_v2
-
 import google.cloud.logging as logger
 logger.handlers.setup_logging(logger.Client().get_default_handler())
 
@@ -86,21 +83,20 @@ def oauth(request, _):
     action = DATA_PROVIDER_ACTION | auth_response.json() | state
     action['expires'] = datetime.datetime.utcnow() \
                         + datetime.timedelta(seconds=action['expires_in'] if 'expires_in' in action else 0)
-    create_action(action, state['action_id'], firestore.Client(), tasks_v2.CloudTasksClient(),
+    create_action(action, state['action_id'], clients.firestore(), clients.tasks(),
                   {'type': 'person', 'value': state['person_id']})
 
     return flask.redirect('https://www.careintent.com', 302)
 
 
 def signup(request, _):
-    db = firestore.Client()
+    db = clients.firestore()
     identifier = request.json['identifier']
     hashpass = base64.b64encode(hashlib.sha256(request.json['password'].encode('utf-8')).digest()).decode('utf-8')
     id_type = 'email' if '@' in identifier else 'phone'
     contact = {'type': id_type, 'value': identifier}
-    person_ref = db.collection('persons').where('identifiers', 'array_contains', contact)
-    persons = list(person_ref.get())
-    if len(persons) > 0:
+    person_id = base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b'=').decode('ascii')
+    if common.add_identifiers({'type': 'person', 'value': person_id}, [contact | {'unverified': True}], db):
         response = flask.jsonify({'status': 'error', 'message': 'Identifier already exists'})
         response.status_code = 409
         return response
@@ -109,10 +105,9 @@ def signup(request, _):
     person = {'identifiers': [contact | {'unverified': True}],
               'login': {'verify': verify_token, 'id': identifier, 'hashpass': hashpass,
                         'signup_time': datetime.datetime.utcnow()}}
-    person_id = base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b'=').decode('ascii')
     db.collection('persons').document(person_id).set(person)
 
-    publisher = pubsub_v1.PublisherClient()
+    publisher = clients.publisher()
     topic_path = publisher.topic_path(config.PROJECT_ID, 'message')
     data = {
         'time': datetime.datetime.utcnow().isoformat(),
@@ -127,24 +122,23 @@ def signup(request, _):
 
 
 def recover(request, response):
-    db = firestore.Client()
+    db = clients.firestore()
     identifier = request.json['identifier']
     id_type = 'email' if '@' in identifier else 'phone'
     contact = {'type': id_type, 'value': identifier}
-    person_ref = db.collection('persons').where('identifiers', 'array_contains', contact)
-    persons = list(person_ref.get())
-    if len(persons) == 0:
+    person_doc = common.get_identified_doc(contact, db, ['person'])
+    if not person_doc:
         response.status_code = 404
         return response
 
     verify_token = str(random.randint(100000, 999999))
-    person = persons[0].to_dict()
+    person = person_doc.to_dict()
     if 'login' not in person:
         person['login'] = {'id': identifier, 'signup_time': datetime.datetime.utcnow()}
     person['login']['verify'] = verify_token
-    db.collection('persons').document(persons[0].id).update(person)
+    db.collection('persons').document(person_doc.id).update(person)
 
-    publisher = pubsub_v1.PublisherClient()
+    publisher = clients.publisher()
     topic_path = publisher.topic_path(config.PROJECT_ID, 'message')
     data = {
         'time': datetime.datetime.utcnow().isoformat(),
@@ -162,7 +156,7 @@ def verify(request, response):
     verify_token = request.json['code']
     hashpass = base64.b64encode(hashlib.sha256(request.json['password'].encode('utf-8')).digest()).decode('utf-8') \
         if 'password' in request.json else None
-    db = firestore.Client()
+    db = clients.firestore()
     person_ref = db.collection('persons').where('login.verify', '==', verify_token)
     persons = list(person_ref.get())
     if len(persons) == 0:
@@ -178,31 +172,33 @@ def verify(request, response):
     if hashpass:
         person['login']['hashpass'] = hashpass
     db.collection('persons').document(persons[0].id).update(person)
+    common.add_identifiers({'type': 'person', 'value': persons[0].id}, person['identifiers'], db)
     return flask.jsonify({'status': 'ok', 'message': 'Success'})
 
 
 def login(request, _):
-    db = firestore.Client()
+    db = clients.firestore()
     identifier = request.json['identifier']
     hashpass = base64.b64encode(hashlib.sha256(request.json['password'].encode('utf-8')).digest()).decode('utf-8')
     id_type = 'email' if '@' in identifier else 'phone'
     contact = {'type': id_type, 'value': identifier}
-    person_ref = db.collection('persons').where('identifiers', 'array_contains', contact)
-    persons = list(person_ref.get())
-    if len(persons) == 0:
+    person_doc = common.get_identified_doc(contact, db, ['person'])
+    if not person_doc:
         response = flask.jsonify({'status': 'error', 'message': 'Not found'})
         response.status_code = 404
         return response
-    person = persons[0].to_dict()
+    person = person_doc.to_dict()
     if 'login' not in person or person['login']['hashpass'] != hashpass:
         response = flask.jsonify({'status': 'error', 'message': 'Forbidden'})
         response.status_code = 403
         return response
+    previous_token = person['login']['token'] if 'token' in person['login'] else None
     person['login']['id'] = identifier
     person['login']['time'] = datetime.datetime.utcnow()
     person['login']['token'] = str(uuid.uuid4())
-    db.collection('persons').document(persons[0].id).update(person)
-    expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=14)
+    db.collection('persons').document(person_doc.id).update(person)
+    expiry = common.create_session(person['login']['token'], {'type': 'person', 'value': person_doc.id}, db,
+                                   previous_token)
     return flask.jsonify({'status': 'ok', 'token': person['login']['token'], 'expiry': expiry.isoformat()})
 
 
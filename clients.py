@@ -0,0 +1,82 @@
+import threading
+
+# Clients are created lazily on first use and reused by later invocations of a warm function instance, so the
+# gRPC channels and connection pools they hold are not rebuilt for every request or event.
+CLIENTS = {}
+LOCK = threading.Lock()
+
+# Messages are sent in batches of up to 1000 messages or 1MB, waiting at most 50ms to fill a batch
+PUBLISHER_BATCH_SETTINGS = {'max_messages': 1000, 'max_bytes': 1000 * 1000, 'max_latency': 0.05}
+
+
+def create_bigquery():
+    from google.cloud import bigquery
+    return bigquery.Client()
+
+
+def create_bigquery_write():
+    from google.cloud import bigquery_storage_v1
+    return bigquery_storage_v1.BigQueryWriteClient()
+
+
+def create_firestore():
+    from google.cloud import firestore
+    return firestore.Client()
+
+
+def create_publisher():
+    from google.cloud import pubsub_v1
+    return pubsub_v1.PublisherClient(batch_settings=pubsub_v1.types.BatchSettings(**PUBLISHER_BATCH_SETTINGS))
+
+
+def create_tasks():
+    from google.cloud import tasks_v2
+    return tasks_v2.CloudTasksClient()
+
+
+FACTORIES = {
+    'bigquery': create_bigquery,
+    'bigquery_write': create_bigquery_write,
+    'firestore': create_firestore,
+    'publisher': create_publisher,
+    'tasks': create_tasks
+}
+
+
+def get(name):
+    client = CLIENTS.get(name)
+    if client is None:
+        with LOCK:
+            if name not in CLIENTS:
+                CLIENTS[name] = FACTORIES[name]()
+            client = CLIENTS[name]
+    return client
+
+
+def register(name, client):
+    """Replaces the shared client, e.g. with a local fake in tests."""
+    CLIENTS[name] = client
+
+
+def reset():
+    CLIENTS.clear()
+
+
+def bigquery():
+    return get('bigquery')
+
+
+def bigquery_write():
+    return get('bigquery_write')
+
+
+def firestore():
+    return get('firestore')
+
+
+def publisher():
+    return get('publisher')
+
+
+def tasks():
+    return get('tasks')
@@ -1,8 +1,12 @@
 import base64
+import clients
+import collections
 import config
 import datetime
 import json
 import logging
+import threading
+import time
 import uuid
 
 COLLECTIONS = {'person': 'persons', 'group': 'groups', 'message': 'messages', 'member': 'members', 'admin': 'admins',
@@ -24,11 +28,110 @@ def get_duration_secs(duration):
     return DURATIONS[duration[-1]] * int(duration[:-1])
 
 
+SESSION_CACHE_SECS = 5 * 60
+SESSION_CACHE_SIZE = 10000
+SESSIONS = {}
+
+IDENTIFIER_CACHE_SIZE = 10000
+IDENTIFIERS = collections.OrderedDict()
+IDENTIFIERS_LOCK = threading.Lock()
+# Identifiers are claimed before their resource is written, a claim of a missing resource is stale after this long
+IDENTIFIER_CLAIM_SECS = 60
+
+RELATION_TYPES = ['member', 'admin']
+# Parent documents and relations of resources without a parents field are reused for this long
+RELATION_CACHE_SECS = 60
+RELATION_CACHE_SIZE = 10000
+RELATIONS = {}
+DOCUMENTS = {}
+
+
 def get_parents(child_id, child_type, db):
     if not child_id or child_type not in COLLECTIONS:
         return []
     relation_query = db.collection_group(COLLECTIONS[child_type]).where('id', '==', child_id)
-    return [relative.reference.parent.parent.get() for relative in relation_query.stream()]
+    return get_documents([relative.reference.parent.parent.path for relative in relation_query.stream()], db)
+
+
+def get_parent_paths(child, db):
+    """Returns {relation type: parent document paths} of a person or group (e.g. the sender of a message) from its
+    denormalized parents field. The field is backfilled from the relations of resources created before it."""
+    if not child or 'id' not in child or not child['id']:
+        return {relation_type: [] for relation_type in RELATION_TYPES}
+    if 'parents' in child:
+        return {relation_type: list(child['parents'][relation_type]) if relation_type in child['parents'] else []
+                for relation_type in RELATION_TYPES}
+    child_id = child['id']
+    key = '{}:{}'.format(child_id['type'], child_id['value'])
+    if key in RELATIONS and time.time() - RELATIONS[key][0] < RELATION_CACHE_SECS:
+        return RELATIONS[key][1]
+    parents = None
+    if child_id['type'] in ['person', 'group']:
+        try:
+            parents = add_parents(child_id, db)
+        except:
+            logging.warning('Failed adding parents to {}'.format(child_id))
+    parents = parents if parents else query_parents(child_id, db)
+    if len(RELATIONS) >= RELATION_CACHE_SIZE:
+        RELATIONS.clear()
+    RELATIONS[key] = (time.time(), parents)
+    return parents
+
+
+def query_parents(child_id, db, transaction=None):
+    return {relation_type: [relative.reference.parent.parent.path for relative in
+                            db.collection_group(COLLECTIONS[relation_type]).where('id', '==', child_id)
+                            .stream(transaction=transaction)]
+            for relation_type in RELATION_TYPES}
+
+
+def add_parents(child_id, db):
+    """Backfills the parents field of the child from its relations. The relations are read in the transaction, so
+    a relation added meanwhile either is read or finds the field and is added to it by update_parents."""
+    from google.cloud import firestore
+
+    @firestore.transactional
+    def add(transaction, child_ref):
+        child_doc = child_ref.get(transaction=transaction)
+        if not child_doc.exists:
+            return None
+        child = child_doc.to_dict()
+        if 'parents' in child:
+            return {relation_type: list(child['parents'][relation_type]) if relation_type in child['parents'] else []
+                    for relation_type in RELATION_TYPES}
+        parents = query_parents(child_id, db, transaction)
+        transaction.update(child_ref, {'parents': parents})
+        return parents
+
+    return add(db.transaction(), db.collection(COLLECTIONS[child_id['type']]).document(child_id['value']))
+
+
+def get_documents(paths, db):
+    """Returns the documents at the paths in the same order, reading the ones not read within RELATION_CACHE_SECS
+    in one batch. Paths that could not be read are returned as None, so the result lines up with the paths."""
+    now = time.time()
+    if len(DOCUMENTS) + len(paths) > RELATION_CACHE_SIZE:
+        DOCUMENTS.clear()
+    stale = [path for path in set(paths) if path not in DOCUMENTS or now - DOCUMENTS[path][0] > RELATION_CACHE_SECS]
+    if stale:
+        for doc in db.get_all([db.document(path) for path in stale]):
+            DOCUMENTS[doc.reference.path] = (now, doc)
+    return [DOCUMENTS[path][1] if path in DOCUMENTS else None for path in paths]
+
+
+def update_parents(child_id, parent_id, relation_type, db, remove=False):
+    """Adds or removes the parent in the parents field of the child, if the child has the field already."""
+    from google.cloud import firestore
+
+    if child_id['type'] not in ['person', 'group']:
+        return
+    RELATIONS.pop('{}:{}'.format(child_id['type'], child_id['value']), None)
+    path = '{}/{}'.format(COLLECTIONS[parent_id['type']], parent_id['value'])
+    child_ref = db.collection(COLLECTIONS[child_id['type']]).document(child_id['value'])
+    child_doc = child_ref.get(['parents'])
+    if child_doc.exists and 'parents' in child_doc.to_dict():
+        child_ref.update({'parents.' + relation_type:
+                          firestore.ArrayRemove([path]) if remove else firestore.ArrayUnion([path])})
 
 
 def get_children_ids(parent_id, child_type, db):
@@ -43,7 +146,8 @@ def get_id(doc):
     return {'type': doc.reference.path.split('/')[-2][:-1], 'value': doc.id}
 
 
-def schedule_task(payload, client, timestamp=None, queue_name='actions', name=None):
+def schedule_task(payload, client=None, timestamp=None, queue_name='actions', name=None):
+    client = client if client else clients.tasks()
     queue = client.queue_path(config.PROJECT_ID, config.LOCATION_ID, queue_name)
     task = {
         'http_request': {  # Specify the type of request.
@@ -64,7 +168,8 @@ def schedule_task(payload, client, timestamp=None, queue_name='actions', name=No
     return response.name
 
 
-def get_task(name, client, queue_name='actions'):
+def get_task(name, client=None, queue_name='actions'):
+    client = client if client else clients.tasks()
     try:
         return client.get_task(name=name if '/' in name
                 else client.task_path(config.PROJECT_ID, config.LOCATION_ID, queue_name, name))
@@ -97,24 +202,76 @@ def generate_id():
     return base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b'=').decode('ascii')
 
 
-def get_proxy_id(parent_id, child_id, db, assign=False):
-    proxy_numbers = config.PROXY_PHONE_NUMBERS.copy() if assign else []
+def get_proxy_ref(parent_id, db):
+    return db.document('proxies/{}:{}'.format(parent_id['type'], parent_id['value']))
+
+
+def get_proxy_map(parent_id, db, transaction=None):
+    """Returns {'children': {child key: proxy number}, 'proxies': {proxy number: child id}} of the parent, built from
+    the members of the parent if the proxy map document doesn't exist yet."""
+    doc = get_proxy_ref(parent_id, db).get(transaction=transaction)
+    if doc.exists:
+        return doc.to_dict()
+    proxy_map = {'children': {}, 'proxies': {}}
     for child in db.collection(COLLECTIONS[parent_id['type']]).document(parent_id['value'])\
-            .collection('members').stream():
-        proxy = child.get('proxy')
-        if child.get('id') == child_id:
-            return proxy
-        if proxy['value'] in proxy_numbers:
-            proxy_numbers.remove(proxy['value'])
-    return {'type': 'phone', 'value': proxy_numbers[0]} if proxy_numbers else None
+            .collection('members').stream(transaction=transaction):
+        child = child.to_dict()
+        if 'id' in child and 'proxy' in child and child['proxy']:
+            proxy_map['children'][child['id']['type'] + ':' + child['id']['value']] = child['proxy']['value']
+            proxy_map['proxies'][child['proxy']['value']] = child['id']
+    if not transaction:
+        try:
+            get_proxy_ref(parent_id, db).create(proxy_map)
+        except:
+            logging.warning('Proxy map of {} already exists'.format(parent_id))
+    return proxy_map
+
+
+def get_proxy_id(parent_id, child_id, db, assign=False):
+    if assign:
+        return assign_proxy_id(parent_id, child_id, db)
+    proxy_map = get_proxy_map(parent_id, db)
+    key = child_id['type'] + ':' + child_id['value']
+    return {'type': 'phone', 'value': proxy_map['children'][key]} if key in proxy_map['children'] else None
 
 
 def get_child_id(parent_id, proxy_id, db):
-    for child in db.collection(COLLECTIONS[parent_id['type']]).document(parent_id['value'])\
-            .collection('members').stream():
-        if child.get('proxy') == proxy_id:
-            return child.get('id')
-    return None
+    proxy_map = get_proxy_map(parent_id, db)
+    return proxy_map['proxies'][proxy_id['value']] if proxy_id['value'] in proxy_map['proxies'] else None
+
+
+def assign_proxy_id(parent_id, child_id, db):
+    """Returns the proxy number of the child, assigning the first free one in a transaction if it has none."""
+    from google.cloud import firestore
+
+    @firestore.transactional
+    def assign(transaction):
+        proxy_map = get_proxy_map(parent_id, db, transaction)
+        key = child_id['type'] + ':' + child_id['value']
+        if key not in proxy_map['children']:
+            free = [number for number in config.PROXY_PHONE_NUMBERS if number not in proxy_map['proxies']]
+            if not free:
+                return None
+            proxy_map['children'][key] = free[0]
+            proxy_map['proxies'][free[0]] = child_id
+            transaction.set(get_proxy_ref(parent_id, db), proxy_map)
+        return {'type': 'phone', 'value': proxy_map['children'][key]}
+
+    return assign(db.transaction())
+
+
+def release_proxy_id(parent_id, child_id, db):
+    from google.cloud import firestore
+
+    @firestore.transactional
+    def release(transaction):
+        proxy_map = get_proxy_map(parent_id, db, transaction)
+        key = child_id['type'] + ':' + child_id['value']
+        if key in proxy_map['children']:
+            proxy_map['proxies'].pop(proxy_map['children'].pop(key), None)
+            transaction.set(get_proxy_ref(parent_id, db), proxy_map)
+
+    release(db.transaction())
 
 
 def add_child(child_id, parent_id, relation_type, db):
@@ -126,20 +283,202 @@ def add_child(child_id, parent_id, relation_type, db):
             return None
     db.collection(COLLECTIONS[parent_id['type']]).document(parent_id['value']) \
         .collection(COLLECTIONS[relation_type]).document(child_id['type'] + ':' + child_id['value']).set(data)
+    update_parents(child_id, parent_id, relation_type, db)
     return data
 
 
+def remove_child(child_id, parent_id, relation_type, db):
+    db.collection(COLLECTIONS[parent_id['type']]).document(parent_id['value']) \
+        .collection(COLLECTIONS[relation_type]).document(child_id['type'] + ':' + child_id['value']).delete()
+    if parent_id['type'] == 'person':
+        release_proxy_id(parent_id, child_id, db)
+    update_parents(child_id, parent_id, relation_type, db, remove=True)
+
+
+def get_identifier_key(identifier):
+    return '{}:{}'.format(identifier['type'], identifier['value']).replace('/', '%2F')
+
+
+def get_identified_id(identifier, db, cached=True):
+    """Returns the id of the person or group with exactly this identifier from the identifiers index. Identifiers of
+    resources added before the index are looked up with an identifiers query and added to the index."""
+    key = get_identifier_key(identifier)
+    entry = None
+    if cached:
+        with IDENTIFIERS_LOCK:
+            if key in IDENTIFIERS:
+                IDENTIFIERS.move_to_end(key)
+                entry = IDENTIFIERS[key]
+    if not entry:
+        doc = db.collection('identifiers').document(key).get()
+        entry = doc.to_dict() if doc.exists else find_identified(identifier, db)
+        if entry:
+            with IDENTIFIERS_LOCK:
+                IDENTIFIERS[key] = entry
+                if len(IDENTIFIERS) > IDENTIFIER_CACHE_SIZE:
+                    IDENTIFIERS.popitem(last=False)
+    return entry['id'] if entry and entry['identifier'] == identifier else None
+
+
+def find_identified(identifier, db):
+    for resource_type in ['person', 'group']:
+        docs = list(db.collection(COLLECTIONS[resource_type]).where('identifiers', 'array_contains', identifier).get())
+        if len(docs) > 1:
+            logging.warning('More than 1 {} for {}'.format(resource_type, identifier))
+        if docs:
+            entry = {'id': {'type': resource_type, 'value': docs[0].id}, 'identifier': identifier}
+            try:
+                db.collection('identifiers').document(get_identifier_key(identifier)).create(entry)
+            except:
+                logging.warning('Identifier {} already indexed'.format(identifier))
+            return entry
+    return None
+
+
+def get_identified_doc(identifier, db, resource_types=('person', 'group')):
+    """Returns the document of the person or group with the identifier, or None. A cached index entry is read again
+    if the identifier has moved to another resource since."""
+    for cached in [True, False]:
+        resource_id = get_identified_id(identifier, db, cached)
+        if not resource_id or resource_id['type'] not in resource_types:
+            return None
+        doc = db.collection(COLLECTIONS[resource_id['type']]).document(resource_id['value']).get()
+        if doc.exists and identifier in (doc.to_dict()['identifiers'] if 'identifiers' in doc.to_dict() else []):
+            return doc
+        with IDENTIFIERS_LOCK:
+            IDENTIFIERS.pop(get_identifier_key(identifier), None)
+    logging.warning('Stale identifier index entry for {}'.format(identifier))
+    return None
+
+
+def add_identifiers(resource_id, identifiers, db):
+    """Claims the identifiers of the person or group in the index, all of them or none, and returns the ids of other
+    resources that have some of them already. Entries of resources that no longer have the identifier are stale and
+    claimed over, except for recent claims of resources that may still be being created."""
+    from google.cloud import firestore
+
+    refs = [db.collection('identifiers').document(get_identifier_key(identifier)) for identifier in identifiers]
+    for identifier, doc in zip(identifiers, db.get_all(refs)):
+        if not doc.exists:
+            # Index entries of resources added before the index
+            find_identified({'type': identifier['type'], 'value': identifier['value']}, db)
+
+    @firestore.transactional
+    def add(transaction):
+        entries = {doc.id: doc.to_dict() for doc in db.get_all(refs, transaction=transaction) if doc.exists}
+        others = {ref.id: entries[ref.id]['id'] for ref in refs
+                  if ref.id in entries and entries[ref.id]['id'] != resource_id}
+        owners = {doc.reference.path: doc for doc in db.get_all(
+            [db.collection(COLLECTIONS[other['type']]).document(other['value']) for other in others.values()],
+            transaction=transaction)} if others else {}
+        conflicts = []
+        for identifier, ref in zip(identifiers, refs):
+            if ref.id in others and is_identified(owners.get('{}/{}'.format(
+                    COLLECTIONS[others[ref.id]['type']], others[ref.id]['value'])), identifier, entries[ref.id]):
+                logging.warning('Identifier {} already used by {}'.format(identifier, others[ref.id]))
+                conflicts.append(others[ref.id])
+        if conflicts:
+            return conflicts
+        for identifier, ref in zip(identifiers, refs):
+            transaction.set(ref, {'id': resource_id, 'identifier': identifier, 'time': time.time()})
+        return []
+
+    conflicts = add(db.transaction())
+    with IDENTIFIERS_LOCK:
+        for ref in refs:
+            IDENTIFIERS.pop(ref.id, None)
+    return conflicts
+
+
+def is_identified(doc, identifier, entry):
+    """Returns whether the index entry of the identifier is in use, i.e. its resource still has the identifier, or
+    was claimed within IDENTIFIER_CLAIM_SECS for a resource that doesn't exist yet."""
+    if not doc or not doc.exists:
+        return 'time' in entry and time.time() - entry['time'] < IDENTIFIER_CLAIM_SECS
+    resource = doc.to_dict()
+    return any(item['type'] == identifier['type'] and item['value'] == identifier['value']
+               for item in (resource['identifiers'] if 'identifiers' in resource else []))
+
+
+def remove_identifiers(resource_id, identifiers, db):
+    for identifier in identifiers:
+        ref = db.collection('identifiers').document(get_identifier_key(identifier))
+        doc = ref.get()
+        if doc.exists and doc.get('id') == resource_id:
+            ref.delete()
+        with IDENTIFIERS_LOCK:
+            IDENTIFIERS.pop(get_identifier_key(identifier), None)
+
+
+def create_person(identifier, db):
+    """Creates a person with the identifier, unless another person got the identifier first (e.g. for concurrent
+    messages from a new sender), and returns the person with its id."""
+    person = {'identifiers': [identifier]}
+    person_id = {'type': 'person', 'value': generate_id()}
+    for _ in range(5):
+        conflicts = add_identifiers(person_id, [identifier], db)
+        if not conflicts:
+            break
+        if conflicts[0]['type'] != 'person':
+            logging.error('Identifier {} used by {}, adding person without it in the index'.format(identifier,
+                                                                                                   conflicts[0]))
+            break
+        doc = db.collection('persons').document(conflicts[0]['value']).get()
+        if doc.exists:
+            return doc.to_dict() | {'id': conflicts[0]}
+        # The other person is still being created
+        time.sleep(1)
+    else:
+        logging.error('Identifier {} claimed by missing {}, adding person without it in the index'.format(
+            identifier, conflicts[0]))
+    db.collection('persons').document(person_id['value']).set(person)
+    return person | {'id': person_id}
+
+
+def create_session(token, person_id, db, previous_token=None):
+    """Stores the login session of the person, ending the previous session, and returns its expiry time."""
+    expiry = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=config.SESSION_SECONDS)
+    db.collection('sessions').document(token).set({'person': person_id, 'expiry': expiry})
+    if previous_token:
+        db.collection('sessions').document(previous_token).delete()
+        SESSIONS.pop(previous_token, None)
+    return expiry
+
+
+def get_session_person_id(token, db):
+    """Returns the id of the person logged in with the token, None if the token is unknown or has expired. Sessions
+    are cached for SESSION_CACHE_SECS, so a session ended on another instance may be accepted for that long."""
+    now = time.time()
+    if token in SESSIONS and now - SESSIONS[token][0] < SESSION_CACHE_SECS:
+        _, person_id, expiry = SESSIONS[token]
+    else:
+        doc = db.collection('sessions').document(token).get()
+        person_id, expiry = (doc.get('person'), doc.get('expiry').timestamp()) if doc.exists \
+            else find_session(token, db)
+        if len(SESSIONS) >= SESSION_CACHE_SIZE:
+            SESSIONS.clear()
+        SESSIONS[token] = (now, person_id, expiry)
+    return person_id if person_id and expiry > now else None
+
+
+def find_session(token, db):
+    """Returns (person id, expiry timestamp) of a login from before the sessions collection, adding the session."""
+    persons = list(db.collection('persons').where('login.token', '==', token).get())
+    if not persons or 'time' not in persons[0].get('login'):
+        return None, 0
+    person_id = {'type': 'person', 'value': persons[0].id}
+    expiry = persons[0].get('login')['time'] + datetime.timedelta(seconds=config.SESSION_SECONDS)
+    if expiry.timestamp() > time.time():
+        db.collection('sessions').document(token).set({'person': person_id, 'expiry': expiry})
+    return person_id, expiry.timestamp()
+
+
 def get_resource(resource, db):
     if not resource or type(resource) != dict or 'value' not in resource or 'type' not in resource:
         return None
     elif resource['type'] == 'phone':
-        person_id = resource
-        persons = list(db.collection('persons').where('identifiers', 'array_contains', person_id).get())
-        if len(persons) > 0:
-            return persons[0].to_dict() | {'id': {'type': 'person', 'value': persons[0].id}}
-        else:
-            groups = list(db.collection('groups').where('identifiers', 'array_contains', resource).get())
-            return (groups[0].to_dict() | {'id': {'type': 'group', 'value': groups[0].id}}) if groups else None
+        doc = get_identified_doc(resource, db)
+        return (doc.to_dict() | {'id': get_id(doc)}) if doc else None
     elif resource['type'] in ['person', 'group']:
         doc = db.collection(COLLECTIONS[resource['type']]).document(resource['value']).get()
         return doc.to_dict() | {'id': resource}
@@ -21,6 +21,9 @@ SENDGRID_TOKEN = 'SG.kPCuBT2LTTWItbORbT8SoQ._lIEpT_Rb_1ol7rTiau5J0qwOSyYcveAe_-5
 
 GAP_SECONDS = 20 * 60
 
+# Used in auth and api functions, login tokens expire after this long
+SESSION_SECONDS = 14 * 60 * 60
+
 PROVIDERS = {'dexcom': {'url': 'https://sandbox-api.dexcom.com/v2/oauth2/token',
                         'client_id': 'cfz2ttzaLK164vTJ3lkt02n7ih0YMBHg',
                         'client_secret': 'NZ4sTh0n4X6AT0XE'},
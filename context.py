@@ -1,5 +1,7 @@
+import collections
 import datetime
 import sys
+import threading
 
 import jinja2
 import json
@@ -8,37 +10,36 @@ import numpy as np
 import pytz
 import re
 
-from inspect import getmembers, isfunction
+from inspect import getmembers, isroutine
+
+TEMPLATE_CACHE_SIZE = 2048
+
+# NumPy functions available to templates through the np filter, looked up once. Most of them (e.g. mean) are array
+# function dispatchers or ufuncs rather than Python functions in recent NumPy versions.
+NUMPY_FUNCTIONS = dict(getmembers(np, lambda member: isroutine(member) or isinstance(member, np.ufunc)))
 
 
 class Context(object):
     def __init__(self):
         self.data = {'from_member': False, 'to_member': False, 'from_coach': False, 'to_coach': False}
-        self.env = jinja2.Environment(loader=jinja2.BaseLoader(), undefined=SilentUndefined)
-        self.env.filters['np'] = self.numpy
-        self.env.filters['timediff'] = self.timediff
+        self.env = ENVIRONMENT
 
     def numpy(self, value, function):
-        functions = {name: value for name, value in getmembers(np, isfunction)}
-        if not function or function not in functions:
-            return value
-        return functions[function](value)
+        return numpy(value, function)
 
     def timediff(self, start, end=None):
-        end = end if end else datetime.datetime.utcnow().astimezone(pytz.utc)
-        start = start if start else datetime.datetime.utcfromtimestamp(0).astimezone(pytz.utc)
-        return (end - start).total_seconds()
+        return timediff(start, end)
 
     def evaluate(self, expression):
         try:
-            return self.env.from_string(expression).render(self.data) == str(True)
+            return TEMPLATES.get(expression).render(self.data) == str(True)
         except:
             return False
 
     def render(self, content):
         if type(content) == str:
             try:
-                return self.env.from_string(content).render(self.data)
+                return TEMPLATES.get(content).render(self.data)
             except:
                 logging.error('Failed rendering {} {}'.format(content, sys.exc_info()))
         elif type(content) == list:
@@ -91,7 +92,7 @@ class Context(object):
                 else:
                     needs_json_load = True
                     try:
-                        value = value.replace(var, json.dumps(context_value))
+                        value = value.replace(var, json.dumps(context_value, default=get_json))
                     except Exception as ex:
                         logging.warning(ex)
             try:
@@ -103,6 +104,104 @@ class Context(object):
         return params
 
 
+class TemplateCache(object):
+    """Bounded LRU of compiled templates keyed by their source, shared by all contexts in the process."""
+    def __init__(self, env, maxsize=TEMPLATE_CACHE_SIZE):
+        self.env = env
+        self.maxsize = maxsize
+        self.templates = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, source):
+        with self.lock:
+            template = self.templates.get(source)
+            if template is not None:
+                self.templates.move_to_end(source)
+                self.hits += 1
+                return template
+            self.misses += 1
+        template = self.env.from_string(source)
+        with self.lock:
+            self.templates[source] = template
+            while len(self.templates) > self.maxsize:
+                self.templates.popitem(last=False)
+        return template
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'size': len(self.templates), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+def numpy(value, function):
+    if not function or function not in NUMPY_FUNCTIONS:
+        return value
+    return NUMPY_FUNCTIONS[function](value)
+
+
+def get_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+
+def get_array(values):
+    """Returns the numbers of the values as a float array, as is if they already are one (e.g. QueryData arrays)."""
+    if isinstance(values, np.ndarray):
+        return values
+    return np.fromiter((value for value in values if type(value) in [int, float]), dtype=np.float64) \
+        if values else np.empty(0)
+
+
+def mean(values):
+    values = get_array(values)
+    return float(values.mean()) if len(values) else None
+
+
+def percentile(values, q=50):
+    values = get_array(values)
+    return float(np.percentile(values, q)) if len(values) else None
+
+
+def slope(values, times=None):
+    """Returns the least squares slope of the values per hour of times (epoch seconds), or per value if no times."""
+    values = get_array(values)
+    times = get_array(times) * (1 / 3600) if times is not None else np.arange(len(values), dtype=np.float64)
+    if len(values) < 2 or len(times) != len(values):
+        return None
+    times = times - times.mean()
+    variance = np.dot(times, times)
+    return float(np.dot(times, values - values.mean()) / variance) if variance else None
+
+
+def time_in_range(values, low, high):
+    """Returns the percentage of the values within [low, high], e.g. of glucose readings taken at regular times."""
+    values = get_array(values)
+    return float(np.count_nonzero((values >= low) & (values <= high)) * 100 / len(values)) if len(values) else None
+
+
+def rolling(values, window):
+    """Returns the means of each window of consecutive values, as an array that the other filters take."""
+    values = get_array(values)
+    window = int(window)
+    if window < 1 or len(values) < window:
+        return np.empty(0)
+    sums = np.cumsum(np.concatenate(([0.0], values)))
+    return (sums[window:] - sums[:-window]) / window
+
+
+def timediff(start, end=None):
+    end = end if end else datetime.datetime.utcnow().astimezone(pytz.utc)
+    start = start if start else datetime.datetime.utcfromtimestamp(0).astimezone(pytz.utc)
+    return (end - start).total_seconds()
+
+
 def merge(destination, source):
     """
     run me with nosetests --with-doctest file.py
@@ -130,3 +229,14 @@ class SilentUndefined(jinja2.Undefined):
     def _fail_with_undefined_error(self, *args, **kwargs):
         logging.debug('%s is undefined' % self._undefined_name)
         return None
+
+
+ENVIRONMENT = jinja2.Environment(loader=jinja2.BaseLoader(), undefined=SilentUndefined)
+ENVIRONMENT.filters['np'] = numpy
+ENVIRONMENT.filters['mean'] = mean
+ENVIRONMENT.filters['percentile'] = percentile
+ENVIRONMENT.filters['slope'] = slope
+ENVIRONMENT.filters['time_in_range'] = time_in_range
+ENVIRONMENT.filters['rolling'] = rolling
+ENVIRONMENT.filters['timediff'] = timediff
+TEMPLATES = TemplateCache(ENVIRONMENT)
@@ -1,4 +1,5 @@
 import abc
+import clients
 import config
 import datetime
 import json
@@ -6,7 +7,6 @@ import logging
 import random
 
 from google.cloud import dialogflow_v2beta1 as dialogflow
-from google.cloud import pubsub_v1
 
 from messages import DATA as messages
 
@@ -30,7 +30,7 @@ class Conversation(abc.ABC):
 
     def publish_data(self, source_id=None, params=None, content=None, tags=()):
         params = params if params else {}
-        publisher = pubsub_v1.PublisherClient()
+        publisher = clients.publisher()
         topic_path = publisher.topic_path(config.PROJECT_ID, 'data')
 
         if type(tags) == list:
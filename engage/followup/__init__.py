@@ -1,14 +1,15 @@
+import clients
 import common
-import config
 import croniter
 import dateutil.parser
 import datetime
 import logging
 import pytz
+import queries
+import recent
 
 from conversation import Conversation as BaseConversation
 
-from google.cloud import bigquery
 
 
 class Conversation(BaseConversation):
@@ -130,10 +131,10 @@ class Conversation(BaseConversation):
             self.config['ended'] = True
 
     def last_completed(self, source, data):
-        bq = bigquery.Client()
-        q = 'SELECT time FROM careintent.live.tsdata, UNNEST(data) '\
-            'WHERE source.value = "{source}" AND name = "{name}" '\
-            'ORDER BY time DESC LIMIT 1'
-        q = q.format(project=config.PROJECT_ID, name=data, source=source)
-        rows = list(bq.query(q))
+        latest_time = recent.get_latest_time(source, data, clients.firestore(), cached=False)
+        if latest_time:
+            return latest_time
+        query = queries.Query('tsdata', ['time'], queries.history_start(), unnest_data=True)
+        query.where('source.value = {}', source).where('name = {}', data).order_by('time DESC').limit(1)
+        rows = list(query.run())
         return rows[0]['time'] if rows else datetime.datetime.utcfromtimestamp(0)
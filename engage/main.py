@@ -1,6 +1,7 @@
 import base64
 import sys
 
+import clients
 import common
 import config
 import croniter
@@ -19,9 +20,6 @@ import chitchat
 from messages import DATA as messages
 
 from context import Context
-from google.cloud import pubsub_v1
-from google.cloud import firestore
-from google.cloud import tasks_v2
 from google.protobuf import timestamp_pb2
 
 import google.cloud.logging as logger
@@ -34,7 +32,7 @@ def main(event, metadata):
     channel_name = metadata.resource['name'].split('/')[-1]
     message = json.loads(base64.b64decode(event['data']).decode('utf-8'))
 
-    db = firestore.Client()
+    db = clients.firestore()
     context = Context()
     context.set(channel_name, message)
     status = context.get('message.status')
@@ -165,7 +163,7 @@ def schedule_next_task(person):
         'content_type': 'application/json',
         'content': {'conversation': timings[0][1] if timings else None}
     }
-    client = tasks_v2.CloudTasksClient()
+    client = clients.tasks()
     current_task = common.get_task(person['task_id'], client, queue_name='engage') if 'task_id' in person else None
     if not current_task:
         return common.schedule_task(data, client, timestamp=next_run_time, queue_name='engage')
@@ -193,7 +191,7 @@ def send_message(sender, receiver, content, db, tags=()):
     if sender == receiver or receiver['value'] in [config.PHONE_NUMBER] + config.PROXY_PHONE_NUMBERS:
         logging.error('Sending message to system phone numbers to {r} from {s}'.format(r=receiver, s=sender))
         return
-    publisher = pubsub_v1.PublisherClient()
+    publisher = clients.publisher()
     topic_path = publisher.topic_path(config.PROJECT_ID, 'message')
     data = {
         'time': datetime.datetime.utcnow().isoformat(),
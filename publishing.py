@@ -0,0 +1,60 @@
+import clients
+import config
+import json
+import logging
+
+PUBLISH_TIMEOUT_SECS = 60
+
+
+class Batch(object):
+    """Publishes messages to a topic through the shared batching publisher and waits for all of them on flush,
+    which has to happen before the invocation returns since the instance may be frozen right after."""
+    def __init__(self, topic, client=None, max_pending=None):
+        self.client = client if client else clients.publisher()
+        self.topic_path = self.client.topic_path(config.PROJECT_ID, topic)
+        self.max_pending = max_pending
+        self.futures = []
+        self.keys = []
+        self.done = []
+        self.published = 0
+        self.failed = 0
+
+    def publish(self, data, key=None, **attributes):
+        """Publishes the data, adding the key (e.g. the id of the receiver) to done once the message is published."""
+        if type(data) != bytes:
+            data = json.dumps(data, default=str).encode('utf-8')
+        if self.max_pending and len(self.futures) >= self.max_pending:
+            self.wait()
+        self.futures.append(self.client.publish(self.topic_path, data, **attributes))
+        self.keys.append(key)
+
+    def wait(self, timeout=PUBLISH_TIMEOUT_SECS):
+        """Waits for the pending messages, so at most max_pending messages are in flight at once."""
+        for future, key in zip(self.futures, self.keys):
+            try:
+                future.result(timeout=timeout)
+                if key is not None:
+                    self.done.append(key)
+            except Exception as ex:
+                self.failed += 1
+                logging.error('Failed publishing to {} {}'.format(self.topic_path, ex))
+        self.published += len(self.futures)
+        self.futures = []
+        self.keys = []
+
+    def flush(self, timeout=PUBLISH_TIMEOUT_SECS):
+        """Waits for the published messages and returns the number of messages that failed."""
+        self.wait(timeout)
+        failed = self.failed
+        if failed:
+            logging.error('Failed publishing {} of {} messages to {}'.format(failed, self.published,
+                                                                             self.topic_path))
+        self.published = 0
+        self.failed = 0
+        return failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
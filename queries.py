@@ -0,0 +1,151 @@
+import clients
+import config
+import datetime
+import logging
+
+# Queries over the whole history of a resource still only scan the partitions of this many days
+HISTORY_DAYS = 2 * 365
+
+# Bucket seconds of the time-series resolutions, and the rollup tables (written by tools/rollup_tsdata.py) that
+# already hold the buckets of a resolution. Resolutions without a table are aggregated from the raw rows.
+RESOLUTIONS = {'5m': 5 * 60, '1h': 60 * 60, '1d': 24 * 60 * 60}
+ROLLUP_TABLES = {'1h': 'tsdata_1h', '1d': 'tsdata_1d'}
+
+PARAMETER_TYPES = {bool: 'BOOL', int: 'INT64', float: 'FLOAT64', str: 'STRING', datetime.datetime: 'TIMESTAMP',
+                   datetime.date: 'DATE'}
+
+
+class Query(object):
+    """Query over a live table with named parameters instead of formatted values, so BigQuery can cache its plan.
+    Queries are bounded on time, the partitioning column of the live tables, unless start is None for the few that
+    need the whole history. Predicates are written with where('source.value = {}', source), each {} becoming a
+    parameter of the given value."""
+    def __init__(self, table, columns, start, end=None, unnest_data=False):
+        self.table = table
+        self.columns = columns
+        self.unnest_data = unnest_data
+        self.params = []
+        self.predicates = []
+        self.group_sql = None
+        self.qualify_sql = None
+        self.order_sql = None
+        self.limit_rows = None
+        if start:
+            self.where('time > {}', get_timestamp(start))
+        if end:
+            self.where('time < {}', get_timestamp(end))
+
+    def where(self, sql, *values):
+        self.predicates.append(sql.format(*[self.param(value) for value in values]))
+        return self
+
+    def group_by(self, sql):
+        self.group_sql = sql
+        return self
+
+    def qualify(self, sql):
+        self.qualify_sql = sql
+        return self
+
+    def order_by(self, sql):
+        self.order_sql = sql
+        return self
+
+    def limit(self, rows):
+        self.limit_rows = int(rows) if rows else None
+        return self
+
+    def param(self, value):
+        """Adds the value as a (name, type, value) parameter and returns its name in the query."""
+        name = 'p%d' % len(self.params)
+        if type(value) in [list, tuple, set]:
+            value = list(value)
+            self.params.append((name, 'ARRAY<%s>' % (PARAMETER_TYPES[type(value[0])] if value else 'STRING'), value))
+        else:
+            self.params.append((name, PARAMETER_TYPES[type(value)], value))
+        return '@' + name
+
+    def sql(self):
+        sql = 'SELECT {columns} FROM `{project}.live.{table}`{unnest}{predicates}'.format(
+            columns=', '.join(self.columns), project=config.PROJECT_ID, table=self.table,
+            unnest=', UNNEST(data)' if self.unnest_data else '',
+            predicates=' WHERE ' + ' AND '.join(self.predicates) if self.predicates else '')
+        if self.group_sql:
+            sql += ' GROUP BY ' + self.group_sql
+        if self.qualify_sql:
+            sql += ' QUALIFY ' + self.qualify_sql
+        if self.order_sql:
+            sql += ' ORDER BY ' + self.order_sql
+        if self.limit_rows:
+            sql += ' LIMIT %d' % self.limit_rows
+        return sql
+
+    def get_query_parameters(self):
+        from google.cloud import bigquery
+
+        parameters = []
+        for name, type_name, value in self.params:
+            if type_name.startswith('ARRAY<'):
+                parameters.append(bigquery.ArrayQueryParameter(name, type_name[6:-1], value))
+            else:
+                parameters.append(bigquery.ScalarQueryParameter(name, type_name, value))
+        return parameters
+
+    def run(self, bq=None):
+        """Runs the query, waits for it to finish and logs the bytes it processed. Returns the query job, which can
+        be iterated for the rows."""
+        from google.cloud import bigquery
+
+        bq = bq if bq else clients.bigquery()
+        sql = self.sql()
+        logging.info('{} {}'.format(sql, [(name, value) for name, _, value in self.params]))
+        job = bq.query(sql, job_config=bigquery.QueryJobConfig(query_parameters=self.get_query_parameters()))
+        job.result()
+        logging.info('Query {} on {} processed {} bytes, billed {} bytes{}'.format(
+            job.job_id, self.table, job.total_bytes_processed, job.total_bytes_billed,
+            ' from cache' if job.cache_hit else ''))
+        return job
+
+
+def get_rollup_query(source, names, start_time, end_time, resolution):
+    """Returns the query of min, max, mean and count of the numbers of each name per bucket of the resolution, from
+    its rollup table or, if it has none, aggregated from the raw rows. The bucket the start time falls in is
+    included."""
+    secs = RESOLUTIONS[resolution]
+    start_time = get_timestamp(start_time) - datetime.timedelta(seconds=secs)
+    columns = ['name', 'min', 'max', 'mean', 'count']
+    if resolution in ROLLUP_TABLES:
+        query = Query(ROLLUP_TABLES[resolution], ['time AS bucket'] + columns, start_time, end_time)
+        query.where('source = {}', source)
+    else:
+        query = Query('tsdata', [get_bucket_sql(secs) + ' AS bucket', 'name', 'MIN(number) AS min',
+                                 'MAX(number) AS max', 'AVG(number) AS mean', 'COUNT(*) AS count'],
+                      start_time, end_time, unnest_data=True)
+        query.where('source.value = {}', source).where('number IS NOT NULL').group_by('bucket, name')
+    return query.where('name IN UNNEST({})', names).order_by('bucket')
+
+
+def get_rollup_row(row, resolution):
+    """Returns the bucket row in the shape of a data row, with its mean as number."""
+    return {'time': row['bucket'].isoformat(),
+            'duration': RESOLUTIONS[resolution],
+            'name': row['name'],
+            'number': row['mean'],
+            'min': row['min'],
+            'max': row['max'],
+            'count': row['count']}
+
+
+def get_timestamp(value):
+    if type(value) == str:
+        value = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+
+
+def get_bucket_sql(secs, column='time'):
+    """Returns SQL of the start of the bucket of given seconds that the timestamp column falls in."""
+    return 'TIMESTAMP_SECONDS(DIV(UNIX_SECONDS({column}), {secs}) * {secs})'.format(column=column, secs=int(secs))
+
+
+def history_start():
+    return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=HISTORY_DAYS)
@@ -1,3 +1,4 @@
+import clients
 import common
 import config
 import datetime
@@ -9,8 +10,6 @@ import pytz
 import twilio.rest
 
 from google.cloud import dialogflow_v2beta1 as dialogflow
-from google.cloud import firestore
-from google.cloud import pubsub_v1
 from twilio.twiml.voice_response import VoiceResponse, Connect, Parameter, Hangup
 
 
@@ -32,24 +31,19 @@ def main(request):
         call = client.calls.get(request.form.get('CallSid')).fetch()
         sender = call.from_
 
-    db = firestore.Client()
+    db = clients.firestore()
     contact = {'type': 'phone', 'value': sender}
-    person_docs = list(db.collection('persons').where('identifiers', 'array_contains', contact).get())
-    if len(person_docs) == 0:
+    person_doc = common.get_identified_doc(contact, db, ['person'])
+    if not person_doc:
         if receiver in config.PROXY_PHONE_NUMBERS:
             # This is spam, new person shouldn't be reaching out to proxy number themselves
             logging.warning('Received spam from %s on %s' % (sender, receiver))
             return '<?xml version="1.0" encoding="UTF-8"?><Response><Hangup/></Response>'
         # Create new person since it doesn't exist
-        person_id = common.generate_id()
-        person = {'identifiers': [contact]}
-        db.collection('persons').document(person_id).set(person)
-        person['id'] = {'type': 'person', 'value': person_id}
+        person = common.create_person(contact, db)
     else:
-        if len(person_docs) > 1:
-            logging.warning('More than 1 person for ' + sender)
-        person = person_docs[0].to_dict()
-        person['id'] = {'type': 'person', 'value': person_docs[0].id}
+        person = person_doc.to_dict()
+        person['id'] = {'type': 'person', 'value': person_doc.id}
 
     tags = ['source:twilio', 'zip:' + request.form.get('FromZip', default='0')]
     sender_id = {'type': 'phone', 'value': sender}
@@ -79,7 +73,7 @@ def main(request):
     elif len(tokens) >= 2 and tokens[1] == 'voice' and 'proxy' not in tags:
         # ('CallStatus', 'ringing' or 'in-progress'), ('Direction', 'inbound'), ('DialCallStatus', 'completed')
         coach_docs = list(filter(lambda g: g and g.exists and g.reference.path.split('/')[0] == 'persons',
-                                 common.get_parents(person['id'], 'member', db)))
+                                 common.get_documents(common.get_parent_paths(person, db)['member'], db)))
         if not coach_docs:
             logging.warning('Coach not assigned to {}'.format(sender))
             return play_audio_recording(person)
@@ -158,7 +152,7 @@ def process_text(sender_id, receiver_id, content, tags, person, db):
         }
     }
 
-    publisher = pubsub_v1.PublisherClient()
+    publisher = clients.publisher()
     topic_path = publisher.topic_path(config.PROJECT_ID, 'message')
 
     if df.query_result.action:
@@ -172,7 +166,7 @@ def process_text(sender_id, receiver_id, content, tags, person, db):
 
 
 def publish_data(person_id, params, tags=(), duration=None):
-    publisher = pubsub_v1.PublisherClient()
+    publisher = clients.publisher()
     topic_path = publisher.topic_path(config.PROJECT_ID, 'data')
 
     row = {
@@ -0,0 +1,183 @@
+import bisect
+import datetime
+import json
+import logging
+import queries
+import threading
+import time
+
+# The data of the last RECENT_SECS of each source and name is kept by save_data in a recent/{source}:{name}
+# document, as columns of times (epoch seconds), durations, numbers and values sorted by time. The columns hold all
+# the data after the since time of the document, so reads starting later don't need to go to BigQuery.
+RECENT_SECS = 7 * 24 * 60 * 60
+RECENT_MAX_POINTS = 4000
+# Estimated size of the columns, below the 1 MiB limit of a document even with long values
+RECENT_MAX_BYTES = 512 * 1024
+# Points of the same source and name arriving together on an instance (e.g. a device backfill) are written in one
+# transaction, the first of them waiting this long for the others
+RECENT_BATCH_SECS = 0.2
+RECENT_CACHE_SECS = 60
+RECENT_CACHE_SIZE = 10000
+RECENT = {}
+
+COLUMNS = ['times', 'durations', 'numbers', 'values']
+
+# {recent key: points waiting for the invocation writing them}
+PENDING = {}
+PENDING_LOCK = threading.Lock()
+
+
+def get_recent_key(source, name):
+    return '{}:{}'.format(source, name).replace('/', '%2F')
+
+
+def get_points(rows):
+    """Returns {(source, name): [(time, duration, number, value)]} of the data rows, in time order. Invalid rows,
+    which can't be written to BigQuery either, are skipped."""
+    points = {}
+    for row in rows:
+        try:
+            row_time = queries.get_timestamp(row['time']).timestamp()
+            row_points = [((row['source']['value'], item['name']),
+                           (row_time, row['duration'] if 'duration' in row else None,
+                            item['number'] if 'number' in item else None, item['value'] if 'value' in item else None))
+                          for item in (row['data'] if 'data' in row else [])]
+        except:
+            logging.warning('Skipping invalid data row {}'.format(row))
+            continue
+        for key, point in row_points:
+            points.setdefault(key, []).append(point)
+    return {key: sorted(key_points, key=lambda point: point[0]) for key, key_points in points.items()}
+
+
+def add_points(recent, points, now):
+    """Adds the points to the columns of the recent document, skipping duplicates, and drops the points older than
+    RECENT_SECS or beyond RECENT_MAX_POINTS or RECENT_MAX_BYTES, moving since after them."""
+    for point in points:
+        if point[0] <= recent['since']:
+            continue
+        index = bisect.bisect_left(recent['times'], point[0])
+        if any(tuple(recent[column][i] for column in COLUMNS) == point
+               for i in range(index, bisect.bisect_right(recent['times'], point[0]))):
+            continue
+        for column, value in zip(COLUMNS, point):
+            recent[column].insert(index, value)
+    drop = max(bisect.bisect_right(recent['times'], now - RECENT_SECS), len(recent['times']) - RECENT_MAX_POINTS)
+    size, keep = 0, len(recent['times'])
+    while keep > drop:
+        size += get_point_size(tuple(recent[column][keep - 1] for column in COLUMNS))
+        if size > RECENT_MAX_BYTES:
+            break
+        keep -= 1
+    drop = keep
+    if drop > 0:
+        recent['since'] = max(recent['since'], recent['times'][drop - 1], now - RECENT_SECS)
+        for column in COLUMNS:
+            del recent[column][:drop]
+    return recent
+
+
+def get_point_size(point):
+    """Returns the estimated size of the point in the columns of a document."""
+    return len(json.dumps(point, default=str))
+
+
+def add_rows(rows, db):
+    """Adds the data rows to the recent documents of their sources and names, in one transaction per document. Points
+    of a document already being written by another invocation on the instance are left to it, and this one returns
+    once they are written."""
+    writes, waits = [], []
+    with PENDING_LOCK:
+        for (source, name), key_points in get_points(rows).items():
+            key = get_recent_key(source, name)
+            if key in PENDING:
+                PENDING[key]['points'].extend(key_points)
+                waits.append(PENDING[key]['done'])
+            else:
+                PENDING[key] = {'source': source, 'name': name, 'points': list(key_points), 'done': threading.Event()}
+                writes.append(key)
+    if writes:
+        time.sleep(RECENT_BATCH_SECS)
+    for key in writes:
+        with PENDING_LOCK:
+            pending = PENDING.pop(key)
+        try:
+            update_recent(db.collection('recent').document(key), pending['source'], pending['name'],
+                          sorted(pending['points'], key=lambda point: point[0]), db)
+        finally:
+            pending['done'].set()
+    for done in waits:
+        done.wait()
+
+
+def update_recent(recent_ref, source, name, points, db):
+    """Adds the points to the recent document in a transaction. If that fails (e.g. on contention) since is moved
+    past the points instead, so reads of their times go to BigQuery while later points stay cached."""
+    from google.cloud import firestore
+
+    @firestore.transactional
+    def update(transaction):
+        recent_doc = recent_ref.get(transaction=transaction)
+        recent = recent_doc.to_dict() if recent_doc.exists else {column: [] for column in COLUMNS}
+        if not recent_doc.exists:
+            recent |= {'source': source, 'name': name, 'since': time.time()}
+        transaction.set(recent_ref, add_points(recent, points, time.time()))
+
+    try:
+        update(db.transaction())
+        return
+    except:
+        logging.exception('Failed to update recent data {}'.format(recent_ref.id))
+    try:
+        recent_ref.update({'since': firestore.Maximum(points[-1][0])})
+    except:
+        # Without the document reads go to BigQuery until it is rebuilt from new data
+        logging.exception('Failed to move since of recent data {}'.format(recent_ref.id))
+        recent_ref.delete()
+
+
+def get_recent(source, names, db, cached=True):
+    """Returns the recent documents of the source and names as dicts (None if missing), reading the ones not
+    cached or read more than RECENT_CACHE_SECS ago in one batch."""
+    now = time.time()
+    keys = [get_recent_key(source, name) for name in names]
+    if len(RECENT) + len(keys) > RECENT_CACHE_SIZE:
+        RECENT.clear()
+    stale = [key for key in set(keys) if not cached or key not in RECENT or now - RECENT[key][0] > RECENT_CACHE_SECS]
+    if stale:
+        for recent_doc in db.get_all([db.collection('recent').document(key) for key in stale]):
+            RECENT[recent_doc.id] = (now, recent_doc.to_dict() if recent_doc.exists else None)
+    return [RECENT[key][1] if key in RECENT else None for key in keys]
+
+
+def get_rows(recents, start_time, end_time=None):
+    """Returns the rows of the recent documents between the times in time order, or None if a document is
+    missing or doesn't hold all the data since the start time."""
+    start = queries.get_timestamp(start_time).timestamp()
+    end = queries.get_timestamp(end_time).timestamp() if end_time else None
+    if not all(recent and recent['since'] <= start for recent in recents):
+        return None
+    rows = []
+    for recent in recents:
+        first = bisect.bisect_right(recent['times'], start)
+        last = bisect.bisect_left(recent['times'], end) if end else len(recent['times'])
+        for i in range(first, last):
+            rows.append({'time': datetime.datetime.fromtimestamp(recent['times'][i], datetime.timezone.utc),
+                         'duration': recent['durations'][i],
+                         'name': recent['name'],
+                         'number': recent['numbers'][i],
+                         'value': recent['values'][i]})
+    return sorted(rows, key=lambda row: row['time'])
+
+
+def get_data(source, names, start_time, end_time, db, cached=True):
+    """Returns the rows of the names of the source between the times from the recent documents, or None if they
+    don't hold all of them and BigQuery has to be queried."""
+    return get_rows(get_recent(source, names, db, cached), start_time, end_time)
+
+
+def get_latest_time(source, name, db, cached=True):
+    recent = get_recent(source, [name], db, cached)[0]
+    if not recent or not recent['times']:
+        return None
+    return datetime.datetime.fromtimestamp(recent['times'][-1], datetime.timezone.utc)
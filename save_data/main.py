@@ -1,13 +1,15 @@
 import base64
-import config
+import clients
 import json
 import logging
-
-from google.cloud import bigquery
+import recent
+import sink
 
 import google.cloud.logging as logger
 logger.handlers.setup_logging(logger.Client().get_default_handler())
 
+BUFFER = sink.RowBuffer('tsdata')
+
 
 def main(event, context):
     """Triggered from a message on a Cloud Pub/Sub topic.
@@ -19,8 +21,11 @@ def main(event, context):
     data = json.loads(base64.b64decode(event['data']).decode('utf-8'))
     logging.info(data)
 
-    client = bigquery.Client()
-    table_id = '%s.live.tsdata' % config.PROJECT_ID
-    errors = client.insert_rows_json(table_id, [data])
-    if errors:
-        logging.error(errors)
+    # A message can also carry a batch of rows
+    rows = data if type(data) == list else [data]
+    BUFFER.add(rows, sink.get_insert_ids(getattr(context, 'event_id', None), len(rows)))
+    try:
+        recent.add_rows(rows, clients.firestore())
+    except:
+        # The rows are already written to BigQuery, raising would redeliver and duplicate them
+        logging.exception('Failed adding recent data')
@@ -0,0 +1 @@
+../recent.py
\ No newline at end of file
@@ -1,14 +1,14 @@
 import base64
-import config
 import datetime
 import json
 import logging
-
-from google.cloud import bigquery
+import sink
 
 import google.cloud.logging as logger
 logger.handlers.setup_logging(logger.Client().get_default_handler())
 
+BUFFER = sink.RowBuffer('messages')
+
 
 def main(event, context):
     """Triggered from a message on a Cloud Pub/Sub topic.
@@ -17,9 +17,15 @@ def main(event, context):
          context (google.cloud.functions.Context): Metadata for the event.
     """
     data = base64.b64decode(event['data']).decode('utf-8')
-    message = json.loads(data)
-    logging.info(message)
+    messages = json.loads(data)
+    logging.info(messages)
+
+    # A message can also carry a batch of messages
+    rows = [get_row(message) for message in (messages if type(messages) == list else [messages])]
+    BUFFER.add(rows, sink.get_insert_ids(getattr(context, 'event_id', None), len(rows)))
 
+
+def get_row(message):
     content = message['content'] if 'content' in message else None
     if content and type(content) != str:
         content = json.dumps(content)
@@ -34,9 +40,4 @@ def main(event, context):
         row['sender'] = {'type': message['sender']['type'], 'value': message['sender']['value']}
     if 'receiver' in message and message['receiver'] and 'type' in message['receiver']:
         row['receiver'] = {'type': message['receiver']['type'], 'value': message['receiver']['value']}
-
-    client = bigquery.Client()
-    table_id = '%s.live.messages' % config.PROJECT_ID
-    errors = client.insert_rows_json(table_id, [row])
-    if errors:
-        logging.error(errors)
+    return row
@@ -0,0 +1 @@
+../sink.py
\ No newline at end of file
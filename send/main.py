@@ -1,4 +1,5 @@
 import base64
+import clients
 import common
 import config
 import json
@@ -6,7 +7,6 @@ import logging
 
 from twilio.rest import Client
 
-from google.cloud import firestore
 import google.cloud.logging as logger
 logger.handlers.setup_logging(logger.Client().get_default_handler())
 
@@ -20,7 +20,7 @@ SENDGRID_TOKEN = 'SG.kPCuBT2LTTWItbORbT8SoQ._lIEpT_Rb_1ol7rTiau5J0qwOSyYcveAe_-5
 
 
 def main(request):
-    db = firestore.Client()
+    db = clients.firestore()
     message = json.loads(base64.b64decode(request.json['message']['data']).decode('utf-8'))
     if 'receiver' not in message or 'type' not in message['receiver'] or 'value' not in message['receiver']:
         logging.warning('Missing or invalid receiver in ' + str(message))
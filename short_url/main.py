@@ -1,12 +1,12 @@
+import clients
 import flask
-from google.cloud import firestore
 
 app = flask.Flask(__name__)
 
 
 @app.route('/<path>')
 def main(path):
-    db = firestore.Client()
+    db = clients.firestore()
     url = db.collection('urls').document(path).get()
     response = flask.make_response()
     if not url or not url.get('redirect'):
@@ -0,0 +1,327 @@
+import atexit
+import clients
+import config
+import datetime
+import dateutil.parser
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+# By default the rows of each event (e.g. the list payload of a Pub/Sub message) are written together before the
+# event is acknowledged. Setting ROW_BUFFER_SIZE above 1 opts into buffering rows across events, written once the
+# buffer holds ROW_BUFFER_SIZE rows, with the next row once the first buffered one is ROW_BUFFER_SECS old, and the
+# rest on shutdown. Rows of acknowledged events are then lost if the instance is killed before the buffer is flushed.
+ROW_BUFFER_SIZE = int(os.environ.get('ROW_BUFFER_SIZE', 1))
+ROW_BUFFER_SECS = float(os.environ.get('ROW_BUFFER_SECS', 10))
+MAX_INSERT_ROWS = 500
+# Rows queued for background writes beyond this are dropped rather than growing the memory of the instance
+BACKGROUND_QUEUE_SIZE = 10000
+
+# One of 'streaming' (legacy streaming inserts), 'storage' (BigQuery Storage Write API) or 'file' (local JSON lines
+# files in SINK_DIR, for tests and local runs). Only streaming inserts de-duplicate rows by insert id, the default
+# stream of the Storage Write API ignores them.
+SINK_WRITER = os.environ.get('SINK_WRITER', 'streaming')
+SINK_DIR = os.environ.get('SINK_DIR', '/tmp/sink')
+
+WRITERS = {}
+WRITERS_LOCK = threading.Lock()
+
+
+class RowBuffer(object):
+    """Buffers rows of a live table and writes them together, once the buffer is full or old enough. Streaming
+    inserts de-duplicate rows with the same insert id, e.g. the Pub/Sub event id of a redelivered message."""
+    def __init__(self, table, max_rows=ROW_BUFFER_SIZE, max_secs=ROW_BUFFER_SECS):
+        self.table = table
+        self.max_rows = max_rows
+        self.max_secs = max_secs
+        self.rows = []
+        self.row_ids = []
+        self.start_time = None
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def add(self, rows, row_ids=None):
+        row_ids = row_ids if row_ids else [None] * len(rows)
+        with self.lock:
+            if not self.rows:
+                self.start_time = time.time()
+            self.rows.extend(rows)
+            self.row_ids.extend(row_ids)
+            if len(self.rows) < self.max_rows and time.time() - self.start_time < self.max_secs:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            rows, row_ids = self.rows, self.row_ids
+            self.rows, self.row_ids = [], []
+        for start in range(0, len(rows), MAX_INSERT_ROWS):
+            write(self.table, rows[start:start + MAX_INSERT_ROWS], row_ids[start:start + MAX_INSERT_ROWS])
+
+
+class BackgroundBuffer(object):
+    """Queues rows of a live table and writes them from a background thread, so requests don't wait for the write.
+    Rows are written once MAX_INSERT_ROWS are queued or max_secs after the first of them, and the rest on shutdown.
+    Instances get little CPU between requests, so rows may also wait until the next request."""
+    def __init__(self, table, max_secs=1, max_queue=BACKGROUND_QUEUE_SIZE):
+        self.table = table
+        self.max_secs = max_secs
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.pending = []
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def add(self, rows):
+        for row in rows:
+            try:
+                self.queue.put_nowait(row)
+            except queue.Full:
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    logging.error('Dropped {} rows of {}, the queue is full'.format(self.dropped, self.table))
+        if not self.thread or not self.thread.is_alive():
+            with self.lock:
+                if not self.thread or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.run, daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            row = self.queue.get()
+            with self.lock:
+                self.pending.append(row)
+            deadline = time.time() + self.max_secs
+            while len(self.pending) < MAX_INSERT_ROWS:
+                try:
+                    row = self.queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                with self.lock:
+                    self.pending.append(row)
+            self.write()
+
+    def write(self):
+        with self.lock:
+            rows, self.pending = self.pending, []
+        for start in range(0, len(rows), MAX_INSERT_ROWS):
+            write(self.table, rows[start:start + MAX_INSERT_ROWS])
+
+    def flush(self):
+        with self.lock:
+            while True:
+                try:
+                    self.pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+        self.write()
+
+
+class StreamingWriter(object):
+    """Writes rows with legacy streaming inserts, which de-duplicate rows by insert id."""
+    def __init__(self, table):
+        self.table_id = '%s.live.%s' % (config.PROJECT_ID, table)
+
+    def write(self, rows, row_ids=None):
+        return clients.bigquery().insert_rows_json(self.table_id, rows, row_ids=row_ids)
+
+
+class StorageWriter(object):
+    """Appends rows to the committed default stream of the table with the BigQuery Storage Write API. The append
+    connection is kept open and reused by later invocations, and every write is a single append of all its rows.
+    Insert ids are ignored, so redelivered rows are not de-duplicated."""
+    def __init__(self, table):
+        from google.cloud.bigquery_storage_v1 import types
+
+        self.table = table
+        self.schema = clients.bigquery().get_table('%s.live.%s' % (config.PROJECT_ID, table)).schema
+        self.message_class = get_message_class(table, self.schema)
+        self.template = types.AppendRowsRequest()
+        self.template.write_stream = '{}/streams/_default'.format(
+            clients.bigquery_write().table_path(config.PROJECT_ID, 'live', table))
+        proto_data = types.AppendRowsRequest.ProtoData()
+        proto_data.writer_schema = types.ProtoSchema(proto_descriptor=get_descriptor(table.capitalize(),
+                                                                                     self.schema))
+        self.template.proto_rows = proto_data
+        self.stream = None
+        self.lock = threading.Lock()
+
+    def write(self, rows, row_ids=None):
+        from google.cloud.bigquery_storage_v1 import exceptions, types
+
+        proto_rows = types.ProtoRows()
+        for row in rows:
+            message = self.message_class()
+            set_fields(message, row, self.schema)
+            proto_rows.serialized_rows.append(message.SerializeToString())
+        request = types.AppendRowsRequest()
+        proto_data = types.AppendRowsRequest.ProtoData()
+        proto_data.rows = proto_rows
+        request.proto_rows = proto_data
+        with self.lock:
+            try:
+                response = self.get_stream().send(request).result()
+            except exceptions.StreamClosedError as ex:
+                # The pooled connection was closed while the instance was idle, so nothing was sent. Other errors
+                # (e.g. a timeout) may come after the rows were committed and are not retried, to not duplicate them.
+                logging.warning('Reconnecting {} stream after {}'.format(self.table, ex))
+                self.close()
+                response = self.get_stream().send(request).result()
+        return list(response.row_errors) if response.row_errors else []
+
+    def get_stream(self):
+        from google.cloud.bigquery_storage_v1 import writer
+
+        if not self.stream or not self.stream.is_active:
+            self.stream = writer.AppendRowsStream(clients.bigquery_write(), self.template)
+        return self.stream
+
+    def close(self):
+        if self.stream:
+            try:
+                self.stream.close()
+            except:
+                pass
+        self.stream = None
+
+
+class FileWriter(object):
+    """Appends rows as JSON lines to a local file per table, a stand-in for BigQuery in tests and local runs."""
+    def __init__(self, table):
+        os.makedirs(SINK_DIR, exist_ok=True)
+        self.path = os.path.join(SINK_DIR, table + '.jsonl')
+        self.lock = threading.Lock()
+
+    def write(self, rows, row_ids=None):
+        with self.lock, open(self.path, 'a') as file:
+            for row in rows:
+                file.write(json.dumps(row, default=str) + '\n')
+        return []
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as file:
+            return [json.loads(line) for line in file]
+
+
+WRITER_TYPES = {'storage': StorageWriter, 'streaming': StreamingWriter, 'file': FileWriter}
+
+
+def get_writer(table):
+    writer = WRITERS.get(table)
+    if writer is None:
+        with WRITERS_LOCK:
+            if table not in WRITERS:
+                try:
+                    WRITERS[table] = WRITER_TYPES[SINK_WRITER](table)
+                except ImportError:
+                    logging.warning('Storage Write API is not available, using streaming inserts')
+                    WRITERS[table] = StreamingWriter(table)
+            writer = WRITERS[table]
+    return writer
+
+
+def write(table, rows, row_ids=None):
+    """Writes rows to the live table (e.g. messages, tsdata or log) and returns the errors."""
+    try:
+        errors = get_writer(table).write(rows, row_ids)
+    except Exception as ex:
+        errors = [str(ex)]
+    if errors:
+        logging.error('Failed writing {} rows to {} {}'.format(len(rows), table, errors))
+    return errors
+
+
+PROTO_TYPES = {'STRING': 9, 'BYTES': 12, 'INTEGER': 3, 'INT64': 3, 'FLOAT': 1, 'FLOAT64': 1, 'BOOLEAN': 8,
+               'BOOL': 8, 'TIMESTAMP': 3, 'DATE': 5, 'NUMERIC': 9, 'BIGNUMERIC': 9, 'DATETIME': 9, 'TIME': 9,
+               'GEOGRAPHY': 9, 'JSON': 9}
+PROTO_MESSAGE_TYPE = 11
+PROTO_LABEL_OPTIONAL = 1
+PROTO_LABEL_REPEATED = 3
+
+
+def get_descriptor(name, schema):
+    """Returns self contained proto2 DescriptorProto for the table schema, with nested types for records."""
+    from google.protobuf import descriptor_pb2
+
+    descriptor = descriptor_pb2.DescriptorProto(name=name)
+    for number, field in enumerate(schema, 1):
+        proto_field = descriptor.field.add(name=field.name, number=number,
+                                           label=PROTO_LABEL_REPEATED if field.mode == 'REPEATED'
+                                           else PROTO_LABEL_OPTIONAL)
+        if field.field_type in ['RECORD', 'STRUCT']:
+            nested = get_descriptor(field.name.capitalize() + 'Record', field.fields)
+            descriptor.nested_type.append(nested)
+            proto_field.type = PROTO_MESSAGE_TYPE
+            proto_field.type_name = nested.name
+        else:
+            proto_field.type = PROTO_TYPES[field.field_type]
+    return descriptor
+
+
+def get_message_class(table, schema):
+    from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+    descriptor = get_descriptor(table.capitalize(), schema)
+    file_descriptor = descriptor_pb2.FileDescriptorProto(name='live_%s.proto' % table, package='live',
+                                                         syntax='proto2')
+    file_descriptor.message_type.append(descriptor)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_descriptor)
+    message_descriptor = pool.FindMessageTypeByName('live.' + descriptor.name)
+    if hasattr(message_factory, 'GetMessageClass'):
+        return message_factory.GetMessageClass(message_descriptor)
+    return message_factory.MessageFactory(pool).GetPrototype(message_descriptor)
+
+
+def set_fields(message, row, schema):
+    for field in schema:
+        value = row.get(field.name) if type(row) == dict else None
+        if value is None:
+            continue
+        is_record = field.field_type in ['RECORD', 'STRUCT']
+        if field.mode == 'REPEATED':
+            for item in value:
+                if is_record:
+                    set_fields(getattr(message, field.name).add(), item, field.fields)
+                elif item is not None:
+                    getattr(message, field.name).append(get_proto_value(item, field.field_type))
+        elif is_record:
+            set_fields(getattr(message, field.name), value, field.fields)
+        else:
+            setattr(message, field.name, get_proto_value(value, field.field_type))
+
+
+def get_proto_value(value, field_type):
+    if field_type == 'TIMESTAMP':
+        if type(value) in [int, float]:
+            return int(value * 1000000)
+        timestamp = value if type(value) == datetime.datetime else dateutil.parser.parse(value)
+        timestamp = timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=datetime.timezone.utc)
+        return int(timestamp.timestamp() * 1000000)
+    elif field_type == 'DATE':
+        date = value if type(value) == datetime.date else dateutil.parser.parse(value).date()
+        return (date - datetime.date(1970, 1, 1)).days
+    elif field_type in ['INTEGER', 'INT64']:
+        return int(value)
+    elif field_type in ['FLOAT', 'FLOAT64']:
+        return float(value)
+    elif field_type in ['BOOLEAN', 'BOOL']:
+        return bool(value)
+    elif field_type == 'BYTES':
+        return value if type(value) == bytes else str(value).encode('utf-8')
+    elif field_type == 'JSON' and type(value) != str:
+        return json.dumps(value, default=str)
+    return value if type(value) == str else str(value)
+
+
+def get_insert_ids(event_id, count):
+    """Returns stable insert ids for the rows of a Pub/Sub event, so redelivered events are not inserted again."""
+    if not event_id:
+        return None
+    return [event_id] if count == 1 else ['%s:%d' % (event_id, i) for i in range(count)]
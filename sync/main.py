@@ -5,6 +5,7 @@ import openai
 from google.cloud import firestore
 from twilio.twiml.voice_response import Gather, VoiceResponse
 
+import clients
 import common
 import config
 
@@ -39,20 +40,16 @@ def main(request):
         logging.warning('Received spam from %s on %s' % (sender, receiver))
         return '<?xml version="1.0" encoding="UTF-8"?><Response><Hangup/></Response>'
 
-    db = firestore.Client()
+    db = clients.firestore()
     contact = {'type': 'phone', 'value': sender}
-    person_docs = list(db.collection('persons').where('identifiers', 'array_contains', contact).get())
-    if len(person_docs) == 0:
+    person_doc = common.get_identified_doc(contact, db, ['person'])
+    if not person_doc:
         # Create new person since it doesn't exist
-        person_id = common.generate_id()
-        person = {'identifiers': [contact]}
-        db.collection('persons').document(person_id).set(person)
-        person['id'] = {'type': 'person', 'value': person_id}
+        person = common.create_person(contact, db)
     else:
-        if len(person_docs) > 1:
-            logging.warning('More than 1 person for ' + sender)
-        person = person_docs[0].to_dict()
-        person['id'] = {'type': 'person', 'value': person_docs[0].id}
+        person = person_doc.to_dict()
+        person['id'] = {'type': 'person', 'value': person_doc.id}
+    person_ref = db.collection('persons').document(person['id']['value'])
 
     tags = ['source:twilio', 'zip:' + request.form.get('FromZip', default='0')]
     sender_id = {'type': 'phone', 'value': sender}
@@ -64,7 +61,7 @@ def main(request):
     if request.form.get('CallStatus') == 'ringing':
         gather.say(question)
         response.append(gather)
-        person_docs[0].reference.update({'session.history': firestore.ArrayUnion([{'out': question}])})
+        person_ref.update({'session.history': firestore.ArrayUnion([{'out': question}])})
     elif request.form.get('CallStatus') == 'in-progress':
         openai.api_key = config.OPENAI_KEY
         content = context
@@ -92,7 +89,7 @@ def main(request):
         logging.info(str(reply))
         gather.say(reply)
         response.append(gather)
-        person_docs[0].reference.update({'session.history': firestore.ArrayUnion(
+        person_ref.update({'session.history': firestore.ArrayUnion(
             [{'in': request.form.get('SpeechResult'), 'out': reply}])})
 
     return str(response)
@@ -1,19 +1,32 @@
+import clients
 import common
-import config
 import croniter
 import datetime
 import json
 import logging
+import os
+import publishing
 import pytz
+import uuid
 
 from google.cloud import firestore
-from google.cloud import pubsub_v1
-from google.cloud import tasks_v2
 from google.protobuf import timestamp_pb2
 
 import google.cloud.logging as logger
 logger.handlers.setup_logging(logger.Client().get_default_handler())
 
+# Person documents are read in batches of this size while the messages of the previous batch are being published
+READ_BATCH_SIZE = 500
+# Number of messages in flight at once
+MAX_PENDING_MESSAGES = int(os.environ.get('MAX_PENDING_MESSAGES', 1000))
+# Group actions are split into this many shard tasks, each reading its own range of member ids, unless the action
+# sets its own shards, 0 or 1 to process all the members in one task
+TASK_SHARDS = int(os.environ.get('TASK_SHARDS', 0))
+# Groups with more members than this are split into child tasks of this many members, 0 to never split
+TASK_CHUNK_SIZE = int(os.environ.get('TASK_CHUNK_SIZE', 0))
+# Fanout documents of failed shard tasks expire after this long (with a TTL policy on expiry), after the retries
+FANOUT_SECONDS = 7 * 24 * 60 * 60
+
 
 def main(request):
     body = request.get_json()
@@ -21,19 +34,23 @@ def main(request):
     # expected {'action_id': action_id, 'policy': policy, 'target_id': target_id}
     # or {'action_id': action_id, 'target_id': target_id}
     # or {'status': 'engage', 'time': , 'sender': person['id'], 'content_type': 'application/json', 'content': {}}
+    # or {'action_id': action_id, 'target_id': target_id, 'action': action, 'person_ids': [person_id]} for a chunk
+    # or {'action_id': action_id, 'target_id': target_id, 'action': action, 'run_id': run_id, 'shard': shard,
+    #     'start': first member document id or None, 'end': member document id after the shard or None}
 
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(config.PROJECT_ID, 'message')
+    batch = publishing.Batch('message', max_pending=MAX_PENDING_MESSAGES)
 
     if 'action_id' not in body:
-        publisher.publish(topic_path, json.dumps(body, default=str).encode('utf-8'))
-        return 'OK'
+        batch.publish(json.dumps(body, default=str).encode('utf-8'))
+        return 'ERROR' if batch.flush() else 'OK'
 
-    db = firestore.Client()
+    db = clients.firestore()
     target_id = body['target_id']
     child_type = 'member' if 'child_type' not in body else body['child_type']
     action = None
-    if 'policy' in body:
+    if 'action' in body:
+        action = body['action']
+    elif 'policy' in body:
         policy_doc = db.collection('policies').document(body['policy']).get()
         if policy_doc and policy_doc.exists:
             action = policy_doc.to_dict()[body['action_id']]
@@ -61,33 +78,121 @@ def main(request):
         logging.error('Missing action for %s' % json.dumps(body))
         return 'ERROR'
 
+    if target_id['type'] == 'group' and 'fanout' in action and not action['fanout']:
+        # Actions of the group itself (e.g. reconciling the tickets of all the members at once) run in one message
+        group_doc = db.collection('groups').document(target_id['value']).get()
+        if not group_doc.exists:
+            logging.error('Missing group {}'.format(target_id['value']))
+            return 'ERROR'
+        batch.publish(json.dumps(get_message(target_id, action | {'parent': group_doc.to_dict() | {'id': target_id}}),
+                                 default=str).encode('utf-8'))
+        return 'ERROR' if batch.flush() else 'OK'
+
+    shards = action['shards'] if 'shards' in action else TASK_SHARDS
+    if target_id['type'] == 'group' and 'shard' not in body and 'person_ids' not in body and shards > 1:
+        # Named after the run, so a retry of this task doesn't schedule the shard tasks again
+        run_id = request.headers.get('X-CloudTasks-TaskName') or uuid.uuid4().hex
+        bounds = get_shard_bounds(get_relation_ref(target_id, child_type, db), shards)
+        for shard, (start, end) in enumerate(bounds):
+            try:
+                common.schedule_task(body | {'action': action, 'run_id': run_id, 'shard': shard, 'start': start,
+                                             'end': end}, name='{}-{}'.format(run_id, shard))
+            except Exception as ex:
+                logging.warning('Shard task {} of {} not scheduled {}'.format(shard, run_id, ex))
+        logging.info('Split members of {} into {} shard tasks'.format(target_id, len(bounds)))
+        return 'OK'
+
     person_ids = []
-    if target_id['type'] == 'group':
+    if 'person_ids' in body:
+        person_ids = body['person_ids']
+    elif 'shard' in body:
+        person_ids = get_shard_ids(get_relation_ref(target_id, child_type, db), body['start'], body['end'])
+    elif target_id['type'] == 'group':
         person_ids = common.get_children_ids(target_id, child_type, db)
     elif target_id['type'] == 'person':
         person_ids = [target_id]
+    person_ids = [person_id for person_id in person_ids if person_id and person_id['type'] == 'person']
+    fanout_ref = db.collection('fanouts').document('{}-{}'.format(body['run_id'], body['shard'])) \
+        if 'shard' in body else None
+    if fanout_ref:
+        # Persons already published to by an earlier, failed attempt of the shard task
+        fanout_doc = fanout_ref.get()
+        published = set(fanout_doc.get('published')) if fanout_doc.exists else set()
+        person_ids = [person_id for person_id in person_ids if person_id['value'] not in published]
+
+    if 'person_ids' not in body and TASK_CHUNK_SIZE and len(person_ids) > TASK_CHUNK_SIZE:
+        for start in range(0, len(person_ids), TASK_CHUNK_SIZE):
+            common.schedule_task(body | {'action': action, 'person_ids': person_ids[start:start + TASK_CHUNK_SIZE]})
+        logging.info('Split {} members of {} into tasks of {}'.format(len(person_ids), target_id, TASK_CHUNK_SIZE))
+        return 'OK'
 
-    for person_id in person_ids:
-        if not person_id or person_id['type'] != 'person':
-            continue
-        person_doc = db.collection('persons').document(person_id['value']).get()
-        data = {
-            'time': datetime.datetime.utcnow().isoformat(),
-            'sender': person_id,
-            'status': 'internal',
-            'tags': ['source:schedule'],
-            'content_type': 'application/json',
-            'content': action | {'parent': person_doc.to_dict() | {'id': person_id}}
-        }
-        publisher.publish(topic_path, json.dumps(data, default=str).encode('utf-8'))
+    for start in range(0, len(person_ids), READ_BATCH_SIZE):
+        refs = [db.collection('persons').document(person_id['value'])
+                for person_id in person_ids[start:start + READ_BATCH_SIZE]]
+        for person_doc in db.get_all(refs):
+            if not person_doc.exists:
+                logging.warning('Missing person {}'.format(person_doc.id))
+                continue
+            person_id = common.get_id(person_doc)
+            data = get_message(person_id, action | {'parent': person_doc.to_dict() | {'id': person_id}})
+            batch.publish(json.dumps(data, default=str).encode('utf-8'), key=person_id['value'])
 
+    failed = batch.flush()
+    if fanout_ref and failed:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        fanout_ref.set({'published': firestore.ArrayUnion(batch.done), 'time': now,
+                        'expiry': now + datetime.timedelta(seconds=FANOUT_SECONDS)}, merge=True)
+    elif fanout_ref:
+        fanout_ref.delete()
+    if failed:
+        # Shard tasks only publish, so a failed shard can be retried by Cloud Tasks without rescheduling the action,
+        # and the retry skips the persons recorded as published
+        return ('ERROR', 500) if fanout_ref else 'ERROR'
     return 'OK'
 
 
+def get_message(sender_id, content):
+    """Returns the internal message that runs the scheduled action in content for the sender."""
+    return {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'sender': sender_id,
+        'status': 'internal',
+        'tags': ['source:schedule'],
+        'content_type': 'application/json',
+        'content': content
+    }
+
+
+def get_relation_ref(target_id, child_type, db):
+    return db.collection(common.COLLECTIONS[target_id['type']]).document(target_id['value']) \
+        .collection(common.COLLECTIONS[child_type])
+
+
+def get_shard_bounds(relation_ref, shards):
+    """Returns (first, next) member document ids of each shard, splitting the members into ranges of ids of about
+    the same size. Only the ids are read here, each shard task reads the members of its own range. The first and last
+    ranges are open, so members added in the meantime are still in a shard."""
+    doc_ids = [doc.id for doc in relation_ref.order_by('__name__').select(['id']).stream()]
+    if not doc_ids:
+        return []
+    size = -(-len(doc_ids) // shards)
+    return [(doc_ids[start] if start else None, doc_ids[start + size] if start + size < len(doc_ids) else None)
+            for start in range(0, len(doc_ids), size)]
+
+
+def get_shard_ids(relation_ref, start, end):
+    query = relation_ref.order_by('__name__')
+    if start:
+        query = query.start_at({'__name__': relation_ref.document(start)})
+    if end:
+        query = query.end_before({'__name__': relation_ref.document(end)})
+    return [doc.get('id') for doc in query.stream()]
+
+
 def schedule_task(body, schedule, timezone):
     now = datetime.datetime.utcnow()
     now = now.astimezone(pytz.timezone(timezone)) if timezone else now
     cron = croniter.croniter(schedule, now)
     next_run_time = timestamp_pb2.Timestamp()
     next_run_time.FromDatetime(cron.get_next(datetime.datetime))
-    return common.schedule_task(body, tasks_v2.CloudTasksClient(), timestamp=next_run_time)
\ No newline at end of file
+    return common.schedule_task(body, clients.tasks(), timestamp=next_run_time)
\ No newline at end of file
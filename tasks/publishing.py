@@ -0,0 +1 @@
+../publishing.py
\ No newline at end of file
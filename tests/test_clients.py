@@ -0,0 +1,21 @@
+import unittest
+from actions import clients
+
+
+class ClientsTestCase(unittest.TestCase):
+    def tearDown(self):
+        clients.reset()
+
+    def testRegister(self):
+        fake = object()
+        clients.register('firestore', fake)
+        self.assertIs(fake, clients.firestore())
+
+    def testLazyCreate(self):
+        created = []
+        clients.FACTORIES['fake'] = lambda: created.append(object()) or created[-1]
+        try:
+            self.assertIs(clients.get('fake'), clients.get('fake'))
+            self.assertEqual(1, len(created))
+        finally:
+            del clients.FACTORIES['fake']
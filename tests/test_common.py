@@ -0,0 +1,105 @@
+import common
+import time
+import unittest
+
+
+class FakeReference(object):
+    def __init__(self, path, data=None):
+        self.path = path
+        self.data = data
+
+    def get(self, transaction=None):
+        return FakeDocument(self.path, self.data)
+
+
+class FakeDocument(object):
+    def __init__(self, path, data=None):
+        self.reference = FakeReference(path)
+        self.exists = True
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+
+class FakeFirestore(object):
+    def __init__(self, documents=None):
+        self.reads = []
+        self.documents = documents if documents else {}
+
+    def document(self, path):
+        return FakeReference(path, self.documents.get(path))
+
+    def get_all(self, refs):
+        self.reads.append(sorted(ref.path for ref in refs))
+        return [FakeDocument(ref.path) for ref in refs]
+
+
+class CommonTestCase(unittest.TestCase):
+    def tearDown(self):
+        common.DOCUMENTS.clear()
+        common.RELATIONS.clear()
+        common.IDENTIFIERS.clear()
+        common.SESSIONS.clear()
+
+    def testParentPaths(self):
+        self.assertEqual({'member': [], 'admin': []}, common.get_parent_paths(None, None))
+        person = {'id': {'type': 'person', 'value': '1'}, 'parents': {'member': ['groups/a', 'persons/2']}}
+        self.assertEqual({'member': ['groups/a', 'persons/2'], 'admin': []}, common.get_parent_paths(person, None))
+
+    def testDocuments(self):
+        db = FakeFirestore()
+        docs = common.get_documents(['groups/a', 'persons/2', 'groups/a'], db)
+        self.assertEqual(['groups/a', 'persons/2', 'groups/a'], [doc.reference.path for doc in docs])
+        common.get_documents(['groups/a', 'groups/b'], db)
+        self.assertEqual([['groups/a', 'persons/2'], ['groups/b']], db.reads)
+
+    def testDocumentsOverflow(self):
+        db = FakeFirestore()
+        size = common.RELATION_CACHE_SIZE
+        common.RELATION_CACHE_SIZE = 3
+        try:
+            common.get_documents(['groups/a', 'groups/b'], db)
+            docs = common.get_documents(['groups/a', 'groups/c'], db)
+        finally:
+            common.RELATION_CACHE_SIZE = size
+        self.assertEqual(['groups/a', 'groups/c'], [doc.reference.path for doc in docs])
+
+    def testProxyMap(self):
+        child_id = {'type': 'person', 'value': '2'}
+        db = FakeFirestore({'proxies/person:1': {'children': {'person:2': '+13166130002'},
+                                                 'proxies': {'+13166130002': child_id}}})
+        parent_id = {'type': 'person', 'value': '1'}
+        self.assertEqual({'type': 'phone', 'value': '+13166130002'}, common.get_proxy_id(parent_id, child_id, db))
+        self.assertIsNone(common.get_proxy_id(parent_id, {'type': 'person', 'value': '3'}, db))
+        self.assertEqual(child_id, common.get_child_id(parent_id, {'type': 'phone', 'value': '+13166130002'}, db))
+        self.assertIsNone(common.get_child_id(parent_id, {'type': 'phone', 'value': '+13166130001'}, db))
+
+    def testIdentifiedId(self):
+        phone = {'type': 'phone', 'value': '+13165550100'}
+        person_id = {'type': 'person', 'value': '1'}
+        common.IDENTIFIERS[common.get_identifier_key(phone)] = {'id': person_id, 'identifier': phone}
+        self.assertEqual(person_id, common.get_identified_id(phone, None))
+        common.IDENTIFIERS[common.get_identifier_key(phone)]['identifier'] = phone | {'unverified': True}
+        self.assertIsNone(common.get_identified_id(phone, None))
+        self.assertEqual('email:a%2Fb@c.com', common.get_identifier_key({'type': 'email', 'value': 'a/b@c.com'}))
+
+    def testIdentified(self):
+        phone = {'type': 'phone', 'value': '+13165550100'}
+        person = FakeDocument('persons/1', {'identifiers': [phone | {'unverified': True}]})
+        self.assertTrue(common.is_identified(person, phone, {}))
+        self.assertFalse(common.is_identified(FakeDocument('persons/1', {'identifiers': []}), phone, {}))
+        missing = FakeDocument('persons/2')
+        missing.exists = False
+        self.assertTrue(common.is_identified(missing, phone, {'time': time.time()}))
+        self.assertFalse(common.is_identified(missing, phone, {'time': time.time() - common.IDENTIFIER_CLAIM_SECS}))
+        self.assertFalse(common.is_identified(None, phone, {}))
+
+    def testSession(self):
+        person_id = {'type': 'person', 'value': '1'}
+        common.SESSIONS['token'] = (time.time(), person_id, time.time() + 60)
+        common.SESSIONS['expired'] = (time.time(), person_id, time.time() - 60)
+        common.SESSIONS['unknown'] = (time.time(), None, 0)
+        self.assertEqual(person_id, common.get_session_person_id('token', None))
+        self.assertIsNone(common.get_session_person_id('expired', None))
+        self.assertIsNone(common.get_session_person_id('unknown', None))
@@ -1,5 +1,6 @@
+import numpy as np
 import unittest
-from actions.context import Context
+from actions.context import Context, TemplateCache
 
 
 class ContextTestCase(unittest.TestCase):
@@ -24,3 +25,38 @@ class ContextTestCase(unittest.TestCase):
         context.clear('message')
         self.assertEqual(None, context.get('message.content'))
         context.clear('foo')
+
+    def testEvaluate(self):
+        context = Context()
+        context.set('message', {'nlp': {'intent': 'system.welcome'}})
+        self.assertTrue(context.evaluate('{{message.nlp.intent == "system.welcome"}}'))
+        self.assertFalse(context.evaluate('{{message.nlp.intent == "system.stop"}}'))
+        self.assertFalse(context.evaluate('{{from_member and message.nlp.intent == "system.welcome"}}'))
+        self.assertFalse(context.evaluate('{{ invalid'))
+
+    def testTemplateCache(self):
+        cache = TemplateCache(Context().env, maxsize=2)
+        first = cache.get('{{1 + 1}}')
+        self.assertIs(first, cache.get('{{1 + 1}}'))
+        self.assertEqual({'size': 1, 'maxsize': 2, 'hits': 1, 'misses': 1}, cache.stats())
+        cache.get('{{2 + 2}}')
+        cache.get('{{3 + 3}}')
+        self.assertEqual(2, cache.stats()['size'])
+        self.assertIsNot(first, cache.get('{{1 + 1}}'))
+        self.assertEqual('2', first.render({}))
+
+    def testStatistics(self):
+        context = Context()
+        context.set('query', {'results': {'glucose': [60, 100, 'high', 200]},
+                              'arrays': {'glucose': np.array([60.0, 100.0, 200.0])},
+                              'times': {'glucose': np.array([0.0, 3600.0, 7200.0])}})
+        self.assertEqual('True', context.render('{{query.arrays.glucose | np("median") == 100}}'))
+        self.assertEqual('120.0', context.render('{{query.arrays.glucose | mean}}'))
+        self.assertEqual('120.0', context.render('{{query.results.glucose | mean}}'))
+        self.assertEqual('100.0', context.render('{{query.arrays.glucose | percentile(50)}}'))
+        self.assertEqual('70.0', context.render('{{query.arrays.glucose | slope(query.times.glucose)}}'))
+        self.assertTrue(context.evaluate('{{query.arrays.glucose | time_in_range(70, 180) < 50}}'))
+        self.assertEqual('[ 80. 150.]', context.render('{{query.arrays.glucose | rolling(2)}}'))
+        self.assertEqual('None', context.render('{{query.arrays.missing | mean}}'))
+        self.assertEqual({'values': {'glucose': [60.0, 100.0, 200.0]}},
+                         context.get_dict({'values': '{"glucose": $query.arrays.glucose}'}))
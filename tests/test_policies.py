@@ -0,0 +1,54 @@
+import numpy as np
+import unittest
+from actions.context import Context
+from actions.policies import ConditionIndex, NEVER, TRUTHY, get_requirements
+
+
+class PoliciesTestCase(unittest.TestCase):
+    def testRequirements(self):
+        self.assertEqual(NEVER, get_requirements('False'))
+        self.assertEqual({}, get_requirements('True'))
+        self.assertEqual({}, get_requirements('{{scheduled_action_id == action.id}}'))
+        self.assertEqual({'message.nlp.intent': {'x'}}, get_requirements('{{message.nlp.intent == "x"}}'))
+        self.assertEqual({'from_member': {TRUTHY}, 'person.session.id': {'survey'}},
+                         get_requirements('{{from_member and person.session.id == "survey" '
+                                          'and message.nlp.params != {}}}'))
+        self.assertEqual({'from_member': {TRUTHY}, 'message.nlp.intent': {'a', 'b'}},
+                         get_requirements('{{from_member and (message.nlp.intent == "a" or '
+                                          '("b" == message.nlp.intent and person.session.id == "s"))}}'))
+        self.assertEqual({'message.nlp.action': {'a', 'b'}},
+                         get_requirements('{{message.nlp.action in ["a", "b"]}}'))
+        self.assertEqual({}, get_requirements('{{not from_member}}'))
+        self.assertEqual({}, get_requirements('{{message.nlp.params.items}}'))
+        self.assertEqual({}, get_requirements('{% if from_member %}True{% endif %}'))
+
+    def testConditionIndex(self):
+        actions = [{'id': 'welcome', 'condition': '{{from_member and message.nlp.intent == "system.welcome"}}'},
+                   {'id': 'stop', 'condition': '{{from_member and message.nlp.intent == "system.stop"}}'},
+                   {'id': 'coach', 'condition': '{{from_coach}}'},
+                   {'id': 'disabled', 'condition': 'False'},
+                   {'id': 'always'}]
+        index = ConditionIndex(actions)
+        context = Context()
+        context.set('message', {'nlp': {'intent': 'system.welcome'}})
+        self.assertEqual({'always'}, index.match(context))
+        context.set('from_member', True)
+        self.assertEqual({'welcome', 'always'}, index.match(context))
+        self.assertTrue(index.matches({'id': 'scheduled'}, context))
+        self.assertFalse(index.matches(actions[1], context))
+        for action in actions:
+            self.assertTrue(index.matches(action, context) or not context.evaluate(action.get('condition', 'True')))
+
+    def testConditionIndexArrays(self):
+        actions = [{'id': 'high', 'condition': '{{query and query.arrays.glucose | mean > 100}}'},
+                   {'id': 'result', 'condition': '{{query == "done"}}'}]
+        index = ConditionIndex(actions)
+        context = Context()
+        context.set('query', {'arrays': {'glucose': np.array([90.0, 120.0, 130.0])}})
+        self.assertEqual({'high'}, index.match(context))
+        context.set('query', {'arrays': {'glucose': np.array([80.0, 90.0])}})
+        self.assertEqual({'high'}, index.match(context))
+        self.assertFalse(context.evaluate(actions[0]['condition']))
+        context.set('query', np.array([1.0, 2.0]))
+        self.assertEqual({'high'}, index.match(context))
+        self.assertEqual({'high'}, index.match(context))
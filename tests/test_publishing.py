@@ -0,0 +1,51 @@
+import publishing
+import unittest
+
+
+class FakeFuture(object):
+    def __init__(self, publisher, error=None):
+        self.publisher = publisher
+        self.error = error
+
+    def result(self, timeout=None):
+        self.publisher.pending -= 1
+        if self.error:
+            raise self.error
+
+
+class FakePublisher(object):
+    def __init__(self):
+        self.pending = 0
+        self.max_pending = 0
+        self.messages = []
+
+    def topic_path(self, project, topic):
+        return 'projects/{}/topics/{}'.format(project, topic)
+
+    def publish(self, topic_path, data, **attributes):
+        self.messages.append(data)
+        self.pending += 1
+        self.max_pending = max(self.pending, self.max_pending)
+        return FakeFuture(self, ValueError('failed') if data == b'"fail"' else None)
+
+
+class PublishingTestCase(unittest.TestCase):
+    def testFlush(self):
+        publisher = FakePublisher()
+        batch = publishing.Batch('message', client=publisher, max_pending=2)
+        for data in ['a', 'fail', 'b', 'c', 'd']:
+            batch.publish(data)
+        self.assertEqual(1, batch.flush())
+        self.assertEqual(5, len(publisher.messages))
+        self.assertEqual(2, publisher.max_pending)
+        self.assertEqual(0, publisher.pending)
+        batch.publish('e')
+        self.assertEqual(0, batch.flush())
+
+    def testDone(self):
+        batch = publishing.Batch('message', client=FakePublisher(), max_pending=2)
+        for data in ['a', 'fail', 'b']:
+            batch.publish(data, key=data)
+        batch.publish('c')
+        self.assertEqual(1, batch.flush())
+        self.assertEqual(['a', 'b'], batch.done)
@@ -0,0 +1,66 @@
+import config
+import datetime
+import queries
+import unittest
+
+
+class TestQueries(unittest.TestCase):
+    def testParameters(self):
+        query = queries.Query('tsdata', ['name', 'value'], '2023-01-01T00:00:00', '2023-01-02T00:00:00Z',
+                              unnest_data=True)
+        query.where('source.value = {}', 'p1').where('name IN UNNEST({})', ['a', 'b']).order_by('time').limit(5)
+        self.assertEqual(query.sql(), 'SELECT name, value FROM `{}.live.tsdata`, UNNEST(data) '
+                         'WHERE time > @p0 AND time < @p1 AND source.value = @p2 AND name IN UNNEST(@p3) '
+                         'ORDER BY time LIMIT 5'.format(config.PROJECT_ID))
+        start = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual(query.params, [('p0', 'TIMESTAMP', start),
+                                        ('p1', 'TIMESTAMP', start + datetime.timedelta(days=1)),
+                                        ('p2', 'STRING', 'p1'),
+                                        ('p3', 'ARRAY<STRING>', ['a', 'b'])])
+
+    def testSameText(self):
+        first = queries.Query('messages', ['time'], queries.history_start()).where('{} IN UNNEST(tags)', 'a')
+        second = queries.Query('messages', ['time'], queries.history_start()).where('{} IN UNNEST(tags)', 'b')
+        self.assertEqual(first.sql(), second.sql())
+
+    def testBuckets(self):
+        query = queries.Query('tsdata', [queries.get_bucket_sql(300) + ' AS bucket', 'AVG(number) AS mean'],
+                              '2023-01-01T00:00:00', unnest_data=True)
+        query.group_by('bucket').order_by('bucket')
+        self.assertEqual(query.sql(), 'SELECT TIMESTAMP_SECONDS(DIV(UNIX_SECONDS(time), 300) * 300) AS bucket, '
+                         'AVG(number) AS mean FROM `{}.live.tsdata`, UNNEST(data) WHERE time > @p0 '
+                         'GROUP BY bucket ORDER BY bucket'.format(config.PROJECT_ID))
+
+    def testUnbounded(self):
+        query = queries.Query('log', ['time'], None).where('type = {}', 'action.run')
+        self.assertEqual(query.sql(), 'SELECT time FROM `{}.live.log` WHERE type = @p0'.format(config.PROJECT_ID))
+        self.assertEqual('SELECT time FROM `{}.live.log`'.format(config.PROJECT_ID),
+                         queries.Query('log', ['time'], None).sql())
+
+    def testRollups(self):
+        query = queries.get_rollup_query('p1', ['glucose'], '2023-01-01T01:00:00', '2023-01-02T00:00:00', '1h')
+        self.assertEqual(query.sql(), 'SELECT time AS bucket, name, min, max, mean, count FROM `{}.live.tsdata_1h` '
+                         'WHERE time > @p0 AND time < @p1 AND source = @p2 AND name IN UNNEST(@p3) '
+                         'ORDER BY bucket'.format(config.PROJECT_ID))
+        self.assertEqual(query.params[0][2], datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc))
+        query = queries.get_rollup_query('p1', ['glucose'], '2023-01-01T01:00:00', None, '5m')
+        self.assertIn('FROM `{}.live.tsdata`, UNNEST(data)'.format(config.PROJECT_ID), query.sql())
+        self.assertIn('number IS NOT NULL', query.sql())
+        self.assertIn('GROUP BY bucket, name', query.sql())
+        bucket = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+        self.assertEqual({'time': '2023-01-01T00:00:00+00:00', 'duration': 3600, 'name': 'glucose', 'number': 120.0,
+                          'min': 80.0, 'max': 180.0, 'count': 12},
+                         queries.get_rollup_row({'bucket': bucket, 'name': 'glucose', 'mean': 120.0, 'min': 80.0,
+                                                 'max': 180.0, 'count': 12}, '1h'))
+
+    def testMergeSql(self):
+        from tools.rollup_tsdata import get_merge_sql
+
+        hourly = get_merge_sql('1h')
+        self.assertIn('MERGE `{}.live.tsdata_1h` T'.format(config.PROJECT_ID), hourly)
+        self.assertIn('FROM `{}.live.tsdata`, UNNEST(data)'.format(config.PROJECT_ID), hourly)
+        self.assertIn('WHEN NOT MATCHED BY SOURCE AND T.time >= @start AND T.time < @end THEN DELETE', hourly)
+        daily = get_merge_sql('1d')
+        self.assertIn('MERGE `{}.live.tsdata_1d` T'.format(config.PROJECT_ID), daily)
+        self.assertIn('SUM(mean * count) / SUM(count) AS mean', daily)
+        self.assertIn('FROM `{}.live.tsdata_1h`'.format(config.PROJECT_ID), daily)
@@ -0,0 +1,20 @@
+import unittest
+from actions.ranking import TicketTable, get_tickets_from_top_persons
+
+
+def ticket(ticket_id, priority, time):
+    return {'id': ticket_id, 'priority': priority, 'time': '2023-01-01T00:00:%02d' % time}
+
+
+class RankingTestCase(unittest.TestCase):
+    def testTopPersons(self):
+        open_tickets = {
+            'a': {1: ticket(1, 2, 1), 2: ticket(2, 5, 3), 3: ticket(3, 5, 2)},
+            'b': {},
+            'c': {4: ticket(4, 5, 4), 5: ticket(5, None, 5)},
+            'd': {6: ticket(6, 3, 6), 7: ticket(7, 4, 7)},
+            'e': {8: ticket(8, 5, 8), 9: ticket(9, 1, 9)}
+        }
+        self.assertEqual([3, 8, 4], [t['id'] for t in get_tickets_from_top_persons(open_tickets)])
+        self.assertEqual([], get_tickets_from_top_persons({'a': {}}))
+        self.assertEqual([0, 3, 5, 7], list(TicketTable(open_tickets).starts))
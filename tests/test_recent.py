@@ -0,0 +1,117 @@
+import datetime
+import recent
+import threading
+import unittest
+
+
+def get_recent(since, times):
+    return {'source': 'p1', 'name': 'glucose', 'since': since, 'times': list(times), 'durations': [None] * len(times),
+            'numbers': [float(t) for t in times], 'values': [None] * len(times)}
+
+
+class FakeDocument(object):
+    def __init__(self, doc_id):
+        self.id = doc_id
+        self.exists = True
+
+    def to_dict(self):
+        return {'key': self.id}
+
+
+class FakeFirestore(object):
+    def __init__(self):
+        self.reads = []
+
+    def collection(self, name):
+        return self
+
+    def document(self, doc_id):
+        return doc_id
+
+    def get_all(self, doc_ids):
+        self.reads.append(sorted(doc_ids))
+        return [FakeDocument(doc_id) for doc_id in doc_ids]
+
+
+class TestRecent(unittest.TestCase):
+    def tearDown(self):
+        recent.RECENT.clear()
+
+    def testCacheOverflow(self):
+        db = FakeFirestore()
+        size = recent.RECENT_CACHE_SIZE
+        recent.RECENT_CACHE_SIZE = 3
+        try:
+            recent.get_recent('p1', ['a', 'b'], db)
+            docs = recent.get_recent('p1', ['a', 'c'], db)
+        finally:
+            recent.RECENT_CACHE_SIZE = size
+        self.assertEqual([{'key': 'p1:a'}, {'key': 'p1:c'}], docs)
+
+    def testPoints(self):
+        rows = [{'time': '2023-01-01T00:05:00', 'source': {'type': 'person', 'value': 'p1'},
+                 'data': [{'name': 'glucose', 'number': 110}, {'name': 'note', 'value': 'ok'}]},
+                {'time': '2023-01-01T00:00:00', 'source': {'type': 'person', 'value': 'p1'}, 'duration': 60,
+                 'data': [{'name': 'glucose', 'number': 100}]},
+                {'source': {'type': 'person', 'value': 'p1'}, 'data': [{'name': 'glucose', 'number': 90}]}]
+        start = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+        self.assertEqual(recent.get_points(rows), {('p1', 'glucose'): [(start, 60, 100, None),
+                                                                       (start + 300, None, 110, None)],
+                                                   ('p1', 'note'): [(start + 300, None, None, 'ok')]})
+
+    def testAddPoints(self):
+        data = recent.add_points(get_recent(10, [20, 40]), [(5, None, 5.0, None), (30, None, 30.0, None),
+                                                            (40, None, 40.0, None)], 100)
+        self.assertEqual(data['times'], [20, 30, 40])
+        self.assertEqual(data['numbers'], [20.0, 30.0, 40.0])
+        self.assertEqual(data['since'], 10)
+
+    def testTrim(self):
+        data = recent.add_points(get_recent(0, range(1, recent.RECENT_MAX_POINTS + 1)),
+                                 [(recent.RECENT_MAX_POINTS + 1, None, 0.0, None)], recent.RECENT_MAX_POINTS)
+        self.assertEqual(len(data['times']), recent.RECENT_MAX_POINTS)
+        self.assertEqual(data['times'][0], 2)
+        self.assertEqual(data['since'], 1)
+        data = recent.add_points(get_recent(0, [10, 20, 30]), [], 25 + recent.RECENT_SECS)
+        self.assertEqual(data['times'], [30])
+        self.assertEqual(data['since'], 25)
+
+    def testTrimBytes(self):
+        data = get_recent(0, [10, 20, 30])
+        data['values'] = ['x' * 100] * 3
+        size = recent.RECENT_MAX_BYTES
+        recent.RECENT_MAX_BYTES = 250
+        try:
+            data = recent.add_points(data, [], 40)
+        finally:
+            recent.RECENT_MAX_BYTES = size
+        self.assertEqual(data['times'], [20, 30])
+        self.assertEqual(data['since'], 10)
+
+    def testAddRows(self):
+        writes = []
+        update_recent = recent.update_recent
+        recent.update_recent = lambda recent_ref, source, name, points, db: writes.append((recent_ref, points))
+        rows = [{'time': '2023-01-01T00:0{}:00'.format(i), 'source': {'type': 'person', 'value': 'p1'},
+                 'data': [{'name': 'glucose', 'number': i}]} for i in range(4)]
+        try:
+            threads = [threading.Thread(target=recent.add_rows, args=([row], FakeFirestore())) for row in rows]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            recent.update_recent = update_recent
+        self.assertEqual(1, len(writes))
+        self.assertEqual('p1:glucose', writes[0][0])
+        self.assertEqual([0, 1, 2, 3], [point[2] for point in writes[0][1]])
+        self.assertEqual({}, recent.PENDING)
+
+    def testRows(self):
+        start = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+        data = get_recent(start.timestamp(), [start.timestamp() + secs for secs in [60, 120, 180]])
+        rows = recent.get_rows([data], start, start + datetime.timedelta(seconds=180))
+        self.assertEqual([row['time'] for row in rows], [start + datetime.timedelta(seconds=60),
+                                                         start + datetime.timedelta(seconds=120)])
+        self.assertIsNone(recent.get_rows([data], start - datetime.timedelta(seconds=1)))
+        self.assertIsNone(recent.get_rows([data, None], start))
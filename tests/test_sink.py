@@ -0,0 +1,93 @@
+import clients
+import datetime
+import sink
+import tempfile
+import threading
+import time
+import unittest
+
+from google.cloud import bigquery
+
+
+class FakeBigQuery(object):
+    def __init__(self):
+        self.inserts = []
+
+    def insert_rows_json(self, table_id, rows, row_ids=None):
+        self.inserts.append((table_id, rows, row_ids))
+        return []
+
+
+class SinkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bq = FakeBigQuery()
+        clients.register('bigquery', self.bq)
+        sink.WRITERS['tsdata'] = sink.StreamingWriter('tsdata')
+        sink.WRITERS['messages'] = sink.StreamingWriter('messages')
+
+    def tearDown(self):
+        clients.reset()
+        sink.WRITERS.clear()
+
+    def testUnbuffered(self):
+        buffer = sink.RowBuffer('tsdata', max_rows=1)
+        buffer.add([{'a': 1}], ['event1'])
+        self.assertEqual([('careintent.live.tsdata', [{'a': 1}], ['event1'])], self.bq.inserts)
+
+    def testEventRows(self):
+        buffer = sink.RowBuffer('tsdata')
+        buffer.add([{'a': 1}, {'a': 2}], sink.get_insert_ids('event1', 2))
+        self.assertEqual([('careintent.live.tsdata', [{'a': 1}, {'a': 2}], ['event1:0', 'event1:1'])],
+                         self.bq.inserts)
+
+    def testBuffered(self):
+        buffer = sink.RowBuffer('messages', max_rows=3, max_secs=60)
+        buffer.add([{'a': 1}], sink.get_insert_ids('event1', 1))
+        buffer.add([{'a': 2}, {'a': 3}], sink.get_insert_ids('event2', 2))
+        buffer.add([{'a': 4}])
+        self.assertEqual([('careintent.live.messages', [{'a': 1}, {'a': 2}, {'a': 3}],
+                           ['event1', 'event2:0', 'event2:1'])], self.bq.inserts)
+        buffer.flush()
+        self.assertEqual(('careintent.live.messages', [{'a': 4}], [None]), self.bq.inserts[-1])
+        buffer.flush()
+        self.assertEqual(2, len(self.bq.inserts))
+
+    def testFileWriter(self):
+        sink_dir = sink.SINK_DIR
+        with tempfile.TemporaryDirectory() as sink.SINK_DIR:
+            writer = sink.WRITERS['log'] = sink.FileWriter('log')
+            self.assertEqual([], sink.write('log', [{'a': 1}, {'a': 2}]))
+            self.assertEqual([{'a': 1}, {'a': 2}], writer.read())
+        sink.SINK_DIR = sink_dir
+
+    def testProtoRows(self):
+        schema = [bigquery.SchemaField('time', 'TIMESTAMP'),
+                  bigquery.SchemaField('value', 'FLOAT'),
+                  bigquery.SchemaField('tags', 'STRING', mode='REPEATED'),
+                  bigquery.SchemaField('source', 'RECORD', fields=[bigquery.SchemaField('type', 'STRING'),
+                                                                   bigquery.SchemaField('value', 'STRING')])]
+        message = sink.get_message_class('tsdata', schema)()
+        sink.set_fields(message, {'time': '2021-01-01T00:00:00Z', 'value': 1, 'tags': ['a', 'b'],
+                                  'source': {'type': 'dexcom', 'value': '1'}}, schema)
+        self.assertEqual(int(datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc).timestamp() * 1000000),
+                         message.time)
+        self.assertEqual(1.0, message.value)
+        self.assertEqual(['a', 'b'], list(message.tags))
+        self.assertEqual('dexcom', message.source.type)
+
+    def testBackgroundBuffer(self):
+        buffer = sink.BackgroundBuffer('tsdata', max_secs=0.01)
+        buffer.add([{'a': 1}, {'a': 2}])
+        for _ in range(100):
+            if self.bq.inserts:
+                break
+            time.sleep(0.01)
+        self.assertEqual([('careintent.live.tsdata', [{'a': 1}, {'a': 2}], None)], self.bq.inserts)
+
+    def testBackgroundFlush(self):
+        buffer = sink.BackgroundBuffer('tsdata', max_queue=3)
+        buffer.thread = threading.current_thread()
+        buffer.add([{'a': i} for i in range(5)])
+        self.assertEqual(2, buffer.dropped)
+        buffer.flush()
+        self.assertEqual([('careintent.live.tsdata', [{'a': 0}, {'a': 1}, {'a': 2}], None)], self.bq.inserts)
@@ -0,0 +1,65 @@
+import argparse
+import datetime
+import numpy as np
+import ranking
+import sys
+import timeit
+
+
+def get_tickets_from_top_persons(open_tickets):
+    """Ranking of ListTickets before it was vectorized, for comparison."""
+    person_data = []
+    max_priority = 0
+    for person, tickets in open_tickets.items():
+        if not tickets:
+            continue
+        person_data.append({'max': np.max([t['priority'] for t in tickets.values()]),
+                            'sum': np.sum([t['priority'] for t in tickets.values()]),
+                            'ticket': sorted(tickets.values(), key=lambda t: t['priority'], reverse=True)[0]})
+        max_priority = max(person_data[-1]['max'], max_priority)
+    return list(map(lambda p: p['ticket'], sorted(filter(lambda p: p['max'] >= max_priority, person_data),
+                                                  key=lambda p: p['sum'], reverse=True)))
+
+
+def get_open_tickets(persons, tickets, max_priority, seed=0):
+    """Returns synthetic open tickets of a group, with tickets of each person opened in time order."""
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2023, 1, 1)
+    open_tickets = {'person%d' % person: {} for person in range(persons)}
+    for ticket_id, (person, priority) in enumerate(zip(rng.integers(0, persons, tickets),
+                                                       rng.integers(0, max_priority + 1, tickets))):
+        open_tickets['person%d' % person][ticket_id] = {
+            'person_id': {'type': 'person', 'value': 'person%d' % person}, 'id': ticket_id, 'title': 'Ticket',
+            'priority': int(priority), 'time': (start + datetime.timedelta(seconds=ticket_id)).isoformat(),
+            'category': 'test'}
+    return open_tickets
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark ranking of the open tickets of a group.')
+    parser.add_argument('--persons', help='Number of persons in the group.', type=int, default=10000)
+    parser.add_argument('--tickets', help='Number of open tickets in the group.', type=int, default=100000)
+    parser.add_argument('--max_priority', help='Highest ticket priority.', type=int, default=10)
+    parser.add_argument('--repeat', help='Number of times to repeat each ranking.', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    open_tickets = get_open_tickets(args.persons, args.tickets, args.max_priority)
+    expected = get_tickets_from_top_persons(open_tickets)
+    actual = ranking.get_tickets_from_top_persons(open_tickets)
+    if [ticket['id'] for ticket in actual] != [ticket['id'] for ticket in expected]:
+        print('Rankings differ')
+        return 1
+
+    loop_secs = min(timeit.repeat(lambda: get_tickets_from_top_persons(open_tickets), number=1, repeat=args.repeat))
+    table = ranking.TicketTable(open_tickets)
+    build_secs = min(timeit.repeat(lambda: ranking.TicketTable(open_tickets), number=1, repeat=args.repeat))
+    rank_secs = min(timeit.repeat(table.get_top_persons, number=1, repeat=args.repeat))
+    print('{} persons, {} tickets, {} top persons'.format(args.persons, args.tickets, len(actual)))
+    print('Python loop: {:.1f}ms'.format(loop_secs * 1000))
+    print('Columnar: {:.1f}ms ({:.1f}ms building columns, {:.1f}ms ranking), {:.1f}x faster'.format(
+        (build_secs + rank_secs) * 1000, build_secs * 1000, rank_secs * 1000, loop_secs / (build_secs + rank_secs)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -6,7 +6,7 @@ import sys
 
 ACTION_TYPES = ['Broadcast', 'CreateAction', 'DataProvider', 'Message', 'OAuth', 'RunAction', 'OpenAI', 'DialogFlow',
                 'UpdateContext', 'UpdateData', 'UpdateRelation', 'UpdateResource', 'ListGroup', 'QueryData',
-                'OpenTicket', 'CloseTicket', 'ListTickets', 'ListMessages', 'Webhook']
+                'OpenTicket', 'CloseTicket', 'ListTickets', 'ReconcileTickets', 'ListMessages', 'Webhook']
 
 DURATIONS = {
     's': 1,
@@ -38,6 +38,8 @@ def create_action(params):
             action['timezone'] = value
         elif name == 'for':
             action['child_type'] = value
+        elif name == 'shards':
+            action['shards'] = int(value)
         elif name == 'actionhold':
             action['hold_secs'] = get_duration_secs(value)
         elif name == 'msgselect':
@@ -1,4 +1,5 @@
 import argparse
+import clients
 import common
 import croniter
 import datetime
@@ -7,8 +8,6 @@ import logging
 import pytz
 import sys
 
-from google.cloud import firestore
-from google.cloud import tasks_v2
 from google.protobuf import timestamp_pb2
 
 from csv2actions import csv2actions
@@ -17,17 +16,25 @@ from survey2actions import csv2actions as survey_csv2actions
 
 PROJECT_ID = 'careintent'
 PROJECT_LOCATION = 'us-central1'
+# Open tickets of the members are rebuilt from the ticket history nightly, repairing drift of the ticket documents.
+# The action runs once for the group, replaying the history of all the members in one query.
+RECONCILE_TICKETS_SCHEDULE = '0 3 * * *'
 
 
 def delete_task(task_id):
     try:
-        client = tasks_v2.CloudTasksClient()
+        client = clients.tasks()
         print('Deleting task %s' % task_id)
         client.delete_task(name=task_id)
     except:
         logging.error('Error deleting task', exc_info=sys.exc_info())
 
 
+def get_reconcile_action(schedule):
+    return {'id': 'reconcile-tickets', 'type': 'ReconcileTickets', 'condition': 'True', 'priority': 10,
+            'schedule': schedule, 'fanout': False, 'params': {'parent_id': '$sender.id'}}
+
+
 def main(argv):
     parser = argparse.ArgumentParser(description='Add or replace actions for a group.')
     parser.add_argument('--policy', help='Id of the policy for the given policy file.')
@@ -37,6 +44,8 @@ def main(argv):
     parser.add_argument('--csv', help='CSV file to read policy from.', type=argparse.FileType('r'))
     parser.add_argument('--survey', help='CSV survey file to read policy from.', type=argparse.FileType('r'))
     parser.add_argument('--save', help='JSON file to write policy actions to.', type=argparse.FileType('w'))
+    parser.add_argument('--reconcile_tickets', help='Schedule reconciling the open tickets of the group members, '
+                        'with an optional cron schedule.', nargs='?', const=RECONCILE_TICKETS_SCHEDULE)
     args = parser.parse_args(argv)
 
     actions = []
@@ -47,12 +56,15 @@ def main(argv):
     elif args.survey and args.policy:
         actions = survey_csv2actions(args.policy, args.survey)
 
+    if args.reconcile_tickets and args.group:
+        actions.append(get_reconcile_action(args.reconcile_tickets))
+
     if args.save:
         json.dump({'actions': actions}, args.save, indent=2)
 
     scheduled = list(filter(lambda a: 'schedule' in a, actions))
     reactive = list(filter(lambda a: 'schedule' not in a, actions))
-    db = firestore.Client()
+    db = clients.firestore()
     if reactive and args.policy:
         db.collection('policies').document(args.policy).set({action['id']: action for action in reactive})
     elif scheduled and args.group:
@@ -68,7 +80,7 @@ def main(argv):
             cron = croniter.croniter(action['schedule'], now)
             timestamp = timestamp_pb2.Timestamp()
             timestamp.FromDatetime(cron.get_next(datetime.datetime))
-            action['task_id'] = common.schedule_task(payload, tasks_v2.CloudTasksClient(), timestamp=timestamp)
+            action['task_id'] = common.schedule_task(payload, clients.tasks(), timestamp=timestamp)
             print('Scheduled task %s' % action['task_id'])
 
             collection.document(action['id']).set(action)
@@ -0,0 +1 @@
+../queries.py
\ No newline at end of file
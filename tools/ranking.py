@@ -0,0 +1 @@
+../actions/ranking.py
\ No newline at end of file
@@ -0,0 +1,93 @@
+import argparse
+import clients
+import config
+import datetime
+import queries
+import sys
+
+from google.cloud import bigquery
+
+# Hourly buckets are aggregated from the raw rows and daily buckets from the hourly ones, so each pass only scans
+# the cheapest table that has the data
+ROLLUP_SOURCES = {'1h': None, '1d': '1h'}
+# Daily buckets are partitioned by month, as a day partition would only hold one row per source and name
+PARTITIONS = {'1h': 'DATE(time)', '1d': 'TIMESTAMP_TRUNC(time, MONTH)'}
+
+CREATE_SQL = '''CREATE TABLE IF NOT EXISTS `{project}.live.{table}` (
+    time TIMESTAMP NOT NULL, source STRING NOT NULL, name STRING NOT NULL,
+    min FLOAT64, max FLOAT64, mean FLOAT64, count INT64)
+PARTITION BY {partition}
+CLUSTER BY source, name'''
+
+RAW_SQL = '''SELECT {bucket} AS time, source.value AS source, name, MIN(number) AS min, MAX(number) AS max,
+        AVG(number) AS mean, COUNT(*) AS count
+    FROM `{project}.live.tsdata`, UNNEST(data)
+    WHERE time >= @start AND time < @end AND number IS NOT NULL
+    GROUP BY 1, 2, 3'''
+
+ROLLUP_SQL = '''SELECT {bucket} AS time, source, name, MIN(min) AS min, MAX(max) AS max,
+        SUM(mean * count) / SUM(count) AS mean, SUM(count) AS count
+    FROM `{project}.live.{table}`
+    WHERE time >= @start AND time < @end
+    GROUP BY 1, 2, 3'''
+
+# Buckets of the range are recomputed in full, so re-running a range (e.g. the current, still filling day) is safe,
+# and buckets of the range left without data (e.g. after rows were deleted) are deleted
+MERGE_SQL = '''MERGE `{project}.live.{table}` T
+USING ({select}) S
+ON T.time = S.time AND T.source = S.source AND T.name = S.name AND T.time >= @start AND T.time < @end
+WHEN MATCHED THEN UPDATE SET min = S.min, max = S.max, mean = S.mean, count = S.count
+WHEN NOT MATCHED THEN INSERT ROW
+WHEN NOT MATCHED BY SOURCE AND T.time >= @start AND T.time < @end THEN DELETE'''
+
+
+def get_merge_sql(resolution):
+    bucket = queries.get_bucket_sql(queries.RESOLUTIONS[resolution])
+    source = ROLLUP_SOURCES[resolution]
+    if source:
+        select = ROLLUP_SQL.format(bucket=bucket, project=config.PROJECT_ID, table=queries.ROLLUP_TABLES[source])
+    else:
+        select = RAW_SQL.format(bucket=bucket, project=config.PROJECT_ID)
+    return MERGE_SQL.format(project=config.PROJECT_ID, table=queries.ROLLUP_TABLES[resolution], select=select)
+
+
+def create_tables(bq):
+    for resolution, table in queries.ROLLUP_TABLES.items():
+        bq.query(CREATE_SQL.format(project=config.PROJECT_ID, table=table, partition=PARTITIONS[resolution])).result()
+        print('Created {}'.format(table))
+
+
+def rollup(bq, resolution, start, end):
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter('start', 'TIMESTAMP', start),
+                                                           bigquery.ScalarQueryParameter('end', 'TIMESTAMP', end)])
+    job = bq.query(get_merge_sql(resolution), job_config=job_config)
+    job.result()
+    print('Rolled up {} from {} to {}: {} rows, {} bytes processed'.format(
+        queries.ROLLUP_TABLES[resolution], start.isoformat(), end.isoformat(), job.num_dml_affected_rows,
+        job.total_bytes_processed))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Roll time-series data up into hourly and daily tables. Run it '
+                                                 'every hour (e.g. from a scheduler) to keep the rollups current.')
+    parser.add_argument('--days', help='Number of past days to recompute.', type=int, default=2)
+    parser.add_argument('--start', help='Start date (YYYY-MM-DD) to recompute from, e.g. for a backfill.')
+    parser.add_argument('--create', help='Create the rollup tables first.', action='store_true')
+    args = parser.parse_args(argv)
+
+    bq = clients.bigquery()
+    if args.create:
+        create_tables(bq)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    end = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    if args.start:
+        start = queries.get_timestamp(datetime.datetime.fromisoformat(args.start))
+    else:
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=args.days - 1)
+    for resolution in ROLLUP_SOURCES:
+        rollup(bq, resolution, start, end if resolution == '1h' else end.replace(hour=0) + datetime.timedelta(days=1))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))